@@ -1,6 +1,6 @@
 {
     'name': 'Datacenter',
-    'version': '1.4.9',
+    'version': '1.5.9',
     'category': 'Tools',
     'summary': 'Tools for managing the Enterprise Datacenter',
     'sequence': 8,
@@ -15,7 +15,9 @@
     'data': [
         # XML, CSV, and YML files, etc. that you want to include
         'views/datacenter_views.xml',
+        'views/datacenter_job_views.xml',
         'security/ir.model.access.csv',
+        'data/datacenter_cron.xml',
     ],
     'assets': {
         'web.assets_backend': [
@@ -37,6 +39,7 @@ Tools for enterprise datacenter administration.
     - Application management
     - Database management
     - Domain management
+    - Background jobs for remote operations
 
 """,
 }
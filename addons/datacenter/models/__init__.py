@@ -1 +1,2 @@
+from . import job
 from . import datacenter
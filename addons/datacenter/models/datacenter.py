@@ -1,50 +1,77 @@
-import re
-from io import StringIO
 from base64 import b64decode
-from functools import reduce
 
 from odoo import models, fields, exceptions
-from paramiko import SSHClient, AutoAddPolicy, RSAKey
-import psycopg2
-
-
-def interpolate(text, data, depth=0, max_depth=20):
-    cache = {}  # initialize the cache
-
-    if depth > max_depth:
-        return text
-
-    pattern = r'%\[[\w\.]+\]'
-
-    def replacement(match):
-        token = match.group(0)  # include the %[ and ] in the token
-        if token in cache:
-            return cache[token]  # if the token is in the cache, return the cached result
-
-        key = token[2:-1]  # remove the %[ and ] from the token
-        try:
-            if isinstance(data, dict):
-                keys = key.split('.')
-                value = reduce(dict.get, keys, data)
-            else:
-                value = getattr(data, key)
-            if value is None:
-                value = token  # if value is None, return the original token
-            else:
-                value = str(value)
-        except AttributeError:
-            value = token  # if an AttributeError is raised, return the original token
-
-        cache[token] = value  # store the result in the cache
-        return value
-
-    interpolated = re.sub(pattern, replacement, text)
-
-    if re.search(pattern, interpolated):
-        return interpolate(interpolated, data, depth=depth+1, max_depth=max_depth)
-    else:
-        return interpolated
 
+from ..tools.ssh_pool import SSH_POOL
+from ..tools.ssh_exec import (
+    run_command, run_many, HOST_TIMEOUT, MAX_WORKERS, OUTPUT_LIMIT,
+)
+from ..tools.jobs import upload_file
+from ..tools.template import (
+    render as render_template, compile_template, TemplateCycleError,
+)
+
+
+# Replace %[field] and %[dotted.path] tokens with values from data,
+# a dict or a record. Templates are compiled once and cached.
+def interpolate(text, data):
+    try:
+        return render_template(text, data)
+    except TemplateCycleError as e:
+        raise exceptions.ValidationError(str(e))
+
+
+# Root paths of every token found in a value, nested dicts included
+def _template_paths(value):
+    if isinstance(value, dict):
+        paths = set()
+        for item in value.values():
+            paths |= _template_paths(item)
+        return paths
+    if isinstance(value, str) and '%[' in value:
+        return set(compile_template(value).paths)
+    return set()
+
+
+# Plain dict per record with every value reachable from paths.
+# Many2one fields become nested dicts so dotted paths keep working, and
+# tokens found in the values read are fetched too (follow_tokens).
+def read_template_data(records, paths, follow_tokens=True):
+    data = {record_id: {} for record_id in records.ids}
+    read_names = set()
+    done = set()
+    todo = set(paths)
+    while todo:
+        done |= todo
+        found = set()
+        names = {path[0] for path in todo if path[0] in records._fields} - read_names
+        read_names |= names
+        for row in (records.read(list(names), load=None) if names else []):
+            for name in names:
+                value = row[name]
+                if records._fields[name].type == 'many2one':
+                    value = {'id': value} if value else None
+                data[row['id']][name] = value
+                if follow_tokens:
+                    found |= _template_paths(value)
+        # Follow dotted paths through many2one fields, one read per comodel
+        subpaths = {}
+        for path in todo:
+            field = records._fields.get(path[0])
+            if len(path) > 1 and field is not None and field.type == 'many2one':
+                subpaths.setdefault(path[0], set()).add(path[1:])
+        for name, comodel_paths in subpaths.items():
+            comodel = records.env[records._fields[name].comodel_name]
+            comodel_ids = {values[name]['id'] for values in data.values() if values[name]}
+            comodel_data = read_template_data(
+                comodel.browse(comodel_ids), comodel_paths, follow_tokens=False)
+            for values in data.values():
+                if values[name]:
+                    values[name].update(comodel_data[values[name]['id']])
+                    if follow_tokens:
+                        found |= _template_paths(values[name])
+        todo = found - done
+    return data
 
 
 class DuplicateMixin(models.AbstractModel):
@@ -56,9 +83,56 @@ class DuplicateMixin(models.AbstractModel):
             record.copy()
 
 
+class TemplateMixin(models.AbstractModel):
+    _name = 'datacenter.template.mixin'
+    _description = 'Mixin to render template fields in bulk'
+
+    # Render the given template fields for every record in self.
+    # Every field referenced by the templates (and by the values they pull
+    # in) is fetched with one read() per round instead of one read per
+    # token per record. Returns {record_id: {field_name: text}}.
+    def render_templates(self, field_names):
+        data = read_template_data(self, {(name,) for name in field_names})
+        rendered = {}
+        for record_id, values in data.items():
+            try:
+                rendered[record_id] = {
+                    name: render_template(values.get(name), values)
+                    for name in field_names
+                }
+            except TemplateCycleError as e:
+                raise exceptions.ValidationError(str(e))
+        return rendered
+
+    def _render_template_field(self, field_name):
+        self.ensure_one()
+        return self.render_templates([field_name])[self.id][field_name]
+
 
 # Datacenter models
 
+# Application operations running one command: command field, expected status
+APP_COMMANDS = {
+    'start': ('start_command', 'running'),
+    'stop': ('stop_command', 'stopped'),
+    'restart': ('restart_command', 'running'),
+    'status': ('status_command', None),
+    'journal': ('journal_command', None),
+}
+
+# Application operations running a script: script field, remote file name
+APP_SCRIPTS = {
+    'install': ('install_script', 'install.sh'),
+    'update': ('update_script', 'update.sh'),
+    'uninstall': ('uninstall_script', 'uninstall.sh'),
+}
+
+# Database operations: script field
+DATABASE_SCRIPTS = {
+    'setup': 'setup_script',
+    'remove': 'remove_script',
+}
+
     
 class AppServer(models.Model):
     _name = 'datacenter.app.server'
@@ -127,69 +201,218 @@ class AppServer(models.Model):
     stderr = fields.Text(
         string='Stderr', required=False, readonly=True,
     )
+    exit_status = fields.Integer(
+        string='Exit Status', required=False, readonly=True,
+    )
+    output_truncated = fields.Boolean(
+        string='Output Truncated', required=False, readonly=True,
+    )
+    output_limit = fields.Integer(
+        string='Output Limit', required=False, default=OUTPUT_LIMIT,
+        help='Bytes of stdout and stderr kept on the server (the tail), 0 keeps everything',
+    )
+    keep_full_log = fields.Boolean(
+        string='Keep Full Log', required=False, default=False,
+        help='Store the complete output of the last command as a compressed attachment',
+    )
+    log_attachment_id = fields.Many2one(
+        string='Full Log', comodel_name='ir.attachment', readonly=True,
+    )
 
     # SSH connection
-    def _get_ssh_client(self):
-        ssh_client = SSHClient()
-        ssh_client.set_missing_host_key_policy(AutoAddPolicy())
-        private_pem_file_str = b64decode(self.private_pem_file).decode('utf-8')
+    def _get_private_pem(self):
+        private_pem_file_str = (
+            b64decode(self.private_pem_file).decode('utf-8')
+            if self.private_pem_file else ''
+        )
         if not private_pem_file_str:
             raise exceptions.ValidationError('Private PEM file is empty')
-        private_key = RSAKey.from_private_key(StringIO(private_pem_file_str))
-        ssh_client.connect(
-            hostname=self.host, port=self.ssh_port, 
-            username=self.os_user, pkey=private_key,
+        return private_pem_file_str
+
+    def _get_ssh_client(self):
+        # Connections are pooled per host/user/key and reused across calls.
+        # Use as `with self._get_ssh_client() as ssh_client:` and do not close
+        # the client, the pool keeps it open while it is checked out.
+        return SSH_POOL.checkout(
+            self.host, self.ssh_port, self.os_user, self._get_private_pem(),
         )
-        return ssh_client
+
+    def _discard_ssh_client(self):
+        for record in self:
+            if not record.host or not record.private_pem_file:
+                continue
+            SSH_POOL.discard(
+                record.host, record.ssh_port, record.os_user,
+                record._get_private_pem(),
+            )
+
+    def write(self, vals):
+        # Drop pooled connections and cached keys built from the old settings
+        if {'host', 'ssh_port', 'os_user', 'private_pem_file'} & set(vals):
+            self._discard_ssh_client()
+        return super(AppServer, self).write(vals)
+
+    def unlink(self):
+        self._discard_ssh_client()
+        return super(AppServer, self).unlink()
 
     def upload(self, file_path, content=None, chmod_exec=False):
         if not content:
             content = self.command
-        ssh_client = self._get_ssh_client()
-        sftp_client = ssh_client.open_sftp()
-        sftp_client.open(file_path, 'w').write(content)
-        if chmod_exec:
-            sftp_client.chmod(file_path, 0o755)
-        sftp_client.close()
-        return file_path
+        with self._get_ssh_client() as ssh_client:
+            return upload_file(ssh_client, file_path, content, chmod_exec)
 
     # Run command
+    def _prepare_command(self, command=None, base_path=None):
+        if not command:
+            return self.command
+        if base_path:
+            if not base_path.startswith('/'):
+                base_path = '%s/%s' % (self.base_path, base_path)
+            command = 'cd %s && %s' % (base_path, command)
+        elif self.base_path:
+            command = 'cd %s && %s' % (self.base_path, command)
+        return command
+
+    def _get_ssh_params(self):
+        return {
+            'host': self.host,
+            'port': self.ssh_port,
+            'username': self.os_user,
+            'pem': self._get_private_pem(),
+        }
+
+    def _get_output_options(self):
+        return {
+            'max_bytes': max(self.output_limit, 0),
+            'keep_log': self.keep_full_log,
+        }
+
+    def _get_result_vals(self, command, result=None, error=None):
+        if error:
+            return {
+                'command': command,
+                'stdout': False,
+                'stderr': error,
+                'exit_status': -1,
+                'output_truncated': False,
+                'state': 'failure',
+                'error_count': self.error_count + 1,
+            }
+        # A command exiting non-zero failed, whatever it printed
+        failed = result.exit_status != 0
+        return {
+            'command': command,
+            'stdout': result.stdout,
+            'stderr': result.stderr,
+            'exit_status': result.exit_status,
+            'output_truncated': result.truncated,
+            'state': 'failure' if failed else 'success',
+            'error_count': self.error_count + 1 if failed else 0,
+        }
+
+    def _store_full_log(self, log):
+        # Keep only the log of the last command
+        self.ensure_one()
+        old_attachment = self.log_attachment_id
+        attachment = self.env['ir.attachment'].create({
+            'name': '%s-%s.log.gz' % (self.name, fields.Datetime.now().strftime('%Y%m%d%H%M%S')),
+            'raw': log,
+            'mimetype': 'application/gzip',
+            'res_model': self._name,
+            'res_id': self.id,
+        })
+        self.log_attachment_id = attachment
+        old_attachment.unlink()
+
     def execute(self, command=None, base_path=None, force=False):
         if self.state == 'pending' and not force:
             return 'Server is busy'
-        if command:
-            if base_path:
-                if not base_path.startswith('/'):
-                    base_path = '%s/%s' % (self.base_path, base_path)
-                command = 'cd %s && %s' % (base_path, command)
-            elif self.base_path:
-                command = 'cd %s && %s' % (self.base_path, command)
-            self.command = command
-        else:
-            command = self.command
+        command = self._prepare_command(command, base_path)
+        self.command = command
         self.state = 'pending'
         self.stdout = None
         self.stderr = None
         try:
-            ssh_client = self._get_ssh_client()
-            _, stdout, stderr = ssh_client.exec_command(command)
-            # Get exit code and output
-            self.stdout = stdout.read().decode()
-            self.stderr = stderr.read().decode()
-            self.state = 'success'
-            self.error_count = 0
+            with self._get_ssh_client() as ssh_client:
+                result = run_command(ssh_client, command, **self._get_output_options())
+            self.write(self._get_result_vals(command, result))
+            if result.log:
+                self._store_full_log(result.log)
         except Exception as e:
-            self.stderr = str(e)
-            self.state = 'failure'
-            self.error_count += 1
+            self.write(self._get_result_vals(command, error=str(e)))
         self.flush()
         return self.stdout
 
+    # Plan of the remote steps of a job (see tools/jobs.py). Like execute(),
+    # the server is busy until the outcome is applied.
+    def _prepare_job_plan(self, steps):
+        self.write({'state': 'pending', 'stdout': None, 'stderr': None})
+        return {
+            'kind': 'ssh',
+            'params': self._get_ssh_params(),
+            'options': self._get_output_options(),
+            'steps': steps,
+        }
+
+    # Store the last command run by a job plan as execute() would
+    def _apply_job_outcome(self, outcome):
+        commands = [(step, result) for step, result in outcome['results'] if result]
+        step, result = commands[-1] if commands else ({'command': self.command}, None)
+        if result and (result.exit_status != 0 or not outcome['error']):
+            self.write(self._get_result_vals(step['command'], result))
+            if result.log:
+                self._store_full_log(result.log)
+        else:
+            self.write(self._get_result_vals(step['command'], error=outcome['error']))
+
+    # Run the same command (or each server's own command) on many servers.
+    # Hosts are contacted in parallel from a bounded thread pool, the threads
+    # never touch the ORM and results are written back in grouped writes.
+    def execute_many(self, command=None, base_path=None, force=False,
+                     timeout=HOST_TIMEOUT, max_workers=MAX_WORKERS):
+        jobs, commands, results = {}, {}, {}
+        for record in self:
+            if record.state == 'pending' and not force:
+                continue
+            commands[record.id] = record._prepare_command(command, base_path)
+            try:
+                jobs[record.id] = (
+                    record._get_ssh_params(), commands[record.id],
+                    record._get_output_options(),
+                )
+            except Exception as e:
+                results[record.id] = (None, str(e))
+        # Like execute(), servers are busy until their result is written.
+        # Hosts that time out come back as errors and end up in failure.
+        self.browse(list(jobs)).write({
+            'state': 'pending', 'stdout': None, 'stderr': None,
+        })
+        self.flush()
+        results.update(run_many(jobs, timeout=timeout, max_workers=max_workers))
+
+        # Group identical values so the whole batch costs a handful of writes
+        groups = {}
+        for record in self.filtered(lambda r: r.id in results):
+            result, error = results[record.id]
+            vals = record._get_result_vals(commands[record.id], result, error)
+            groups.setdefault(tuple(sorted(vals.items())), []).append(record.id)
+        for vals, ids in groups.items():
+            self.browse(ids).write(dict(vals))
+        for record_id, (result, error) in results.items():
+            if result and result.log:
+                self.browse(record_id)._store_full_log(result.log)
+        self.flush()
+        return {
+            record_id: error or result.stdout
+            for record_id, (result, error) in results.items()
+        }
+
 
 class Application(models.Model):
     _name = 'datacenter.application'
     _description = 'Application'
-    _inherit = ['duplicate.mixin']
+    _inherit = ['duplicate.mixin', 'datacenter.job.mixin', 'datacenter.template.mixin']
 
     name = fields.Char(string='Name', required=True)
     app_code = fields.Char(
@@ -282,74 +505,98 @@ class Application(models.Model):
         default=lambda self: 'No messages',
     )
 
+    def _get_job_server(self):
+        return self.server_id
+
     def _expect_status(self, status):
         self.expected_status = status
         self.flush()
 
-    def _run_command(self, command):
-        command = interpolate(command, self)
-        self.last_message = self.server_id.execute(
-            command=command, base_path=self.base_path)
+    # Remote steps of each operation, rendered beforehand so the job can
+    # run them without a transaction open
+    def _prepare_job(self, method):
+        server = self.server_id
+        if method in APP_COMMANDS:
+            command_field, status = APP_COMMANDS[method]
+            if not server:
+                raise exceptions.ValidationError('Missing server')
+            values = self.render_templates([command_field, 'base_path'])[self.id]
+            if status:
+                self._expect_status(status)
+            steps = [{
+                'op': 'status' if method == 'status' else 'execute',
+                'command': server._prepare_command(values[command_field], values['base_path']),
+            }]
+            return server._prepare_job_plan(steps)
+
+        script_field, filename = APP_SCRIPTS[method]
+        if not server or not self[script_field]:
+            raise exceptions.ValidationError('Missing server or %s script' % method)
+        values = self.render_templates([script_field, 'status_command', 'base_path'])[self.id]
+        file_path = '%s/%s' % (values['base_path'], filename)
+        steps = [
+            {'op': 'upload', 'path': file_path, 'content': values[script_field], 'chmod_exec': True},
+            {'op': 'execute', 'command': server._prepare_command(file_path, values['base_path'])},
+        ]
+        if method == 'install':
+            # Make sure the base path exists or the upload will fail
+            steps.insert(0, {
+                'op': 'execute',
+                'command': server._prepare_command('mkdir -p %s' % values['base_path']),
+            })
+        if method == 'uninstall':
+            # Check the server is stopped first
+            steps.insert(0, {
+                'op': 'expect_stopped',
+                'command': server._prepare_command(values['status_command'], values['base_path']),
+                'pattern': self.status_pattern,
+            })
+        return server._prepare_job_plan(steps)
+
+    def _apply_job_outcome(self, method, outcome):
+        self.server_id._apply_job_outcome(outcome)
+        message = outcome['error']
+        status = None
+        for step, result in outcome['results']:
+            if result:
+                message = outcome['error'] or result.stdout
+            if result and step['op'] in ('status', 'expect_stopped'):
+                status = 'running' if self.status_pattern in (result.stdout or '') else 'stopped'
+                self._expect_status(status)
+        self.last_message = message
+        return status if method == 'status' else message
 
     # Operations (buttons)
     def start(self):
-        self._expect_status('running')
-        self._run_command(self.start_command)
+        return self._run_job_now('start')
 
     def stop(self):
-        self._expect_status('stopped')
-        self._run_command(self.stop_command)
+        return self._run_job_now('stop')
 
     def restart(self):
-        self._expect_status('running')
-        self._run_command(self.restart_command)
-        
+        return self._run_job_now('restart')
+
     def status(self):
-        command = interpolate(self.status_command, self)
-        result = self.server_id.execute(
-            command=command, base_path=self.base_path)
-        status = 'running' if self.status_pattern in result else 'stopped'
-        self.last_message = result
-        self._expect_status(status)
-        return status
+        return self._run_job_now('status')
 
     def journal(self):
-        self._run_command(self.journal_command)
-
-    def _run_as_script(self, content, filename):
-        content = interpolate(content, self)
-        file_path = '%s/%s' % (self.base_path, filename)
-        file_path = self.server_id.upload(
-            content=content, file_path=file_path, chmod_exec=True)
-        self.last_message = self.server_id.execute(
-            command=file_path, base_path=self.base_path)
-    
+        return self._run_job_now('journal')
+
     # Lifecycle (buttons)
     def install(self):
-        if not self.server_id or not self.install_script:
-            raise exceptions.ValidationError('Missing server or install script')
-        # Make sure the base path exists or the upload will fail
-        self.server_id.execute(command='mkdir -p %s' % self.base_path)
-        self._run_as_script(self.install_script, 'install.sh')
+        return self._run_job_now('install')
 
     def update(self):
-        if not self.server_id or not self.update_script:
-            raise exceptions.ValidationError('Missing server or update script')
-        self._run_as_script(self.update_script, 'update.sh')
+        return self._run_job_now('update')
 
     def uninstall(self):
-        # Check the server is stopped first
-        if self.status() == 'running':
-            raise exceptions.ValidationError('Application must be stopped first')
-        if not self.server_id or not self.uninstall_script:
-            raise exceptions.ValidationError('Missing server or uninstall script') 
-        self._run_as_script(self.uninstall_script, 'uninstall.sh')
+        return self._run_job_now('uninstall')
 
 
 class AppDatabase(models.Model):
     _name = 'datacenter.app.database'
     _description = 'Database'
-    _inherit = ['duplicate.mixin']
+    _inherit = ['duplicate.mixin', 'datacenter.job.mixin', 'datacenter.template.mixin']
 
     name = fields.Char(string='Name', required=True)
     server_name = fields.Char(
@@ -389,52 +636,69 @@ class AppDatabase(models.Model):
     remove_script = fields.Text(
         string='Remove Script', required=False,
     )
+    sql_mode = fields.Selection(
+        string='Execution Mode', required=True,
+        selection=[
+            ('statement', 'Statement by statement'),
+            ('transaction', 'Single transaction'),
+            ('batch', 'Single round trip'),
+        ],
+        default='statement',
+        help='Statement by statement runs in autocommit and keeps going after errors '
+             '(needed for CREATE DATABASE). Single transaction stops and rolls back '
+             'at the first error. Single round trip sends the whole script at once and '
+             'reports one timing for the whole script instead of one per statement.',
+    )
 
     last_message = fields.Text(
         string='Last Message', required=False, readonly=True,
         default=lambda self: 'No messages',
     )
 
-    def _run_sql(self, content):
-        # Run the SQL using psycopg2
-        conn = psycopg2.connect(
-            host=self.ip_address, port=self.db_port, 
-            user=self.admin_db_user, database=self.admin_db_name,
-        )
-        conn.autocommit = True
-        cur = conn.cursor()
-
-        # Split the content into separate commands
-        commands = content.split(";")
-        errors = []  # List to store any error messages
-        for command in commands:
-            command = command.strip()  # Remove leading/trailing whitespace
-            if not command:  # Skip empty commands
-                continue
-            try:
-                cur.execute(command)
-            except Exception as e:
-                errors.append(str(e))  # Add the error message to the list
-
-        # If there were any errors, store them in last_message
-        if errors:
-            self.last_message = "\n".join(errors)
+    # Connections are pooled per endpoint/port/user/database (tools/sql.py)
+    def _prepare_job(self, method):
+        script_field = DATABASE_SCRIPTS[method]
+        if not self[script_field]:
+            raise exceptions.ValidationError('Missing %s script' % method)
+        return {
+            'kind': 'sql',
+            'params': {
+                'host': self.ip_address,
+                'port': self.db_port,
+                'user': self.admin_db_user,
+                'dbname': self.admin_db_name,
+            },
+            'script': self._render_template_field(script_field),
+            'mode': self.sql_mode,
+        }
+
+    def _apply_job_outcome(self, method, outcome):
+        if outcome['results'] or not outcome['error']:
+            self.last_message = self._format_sql_results(outcome['results'])
         else:
-            self.last_message = str(cur.fetchall())
-
-        conn.commit()
-        cur.close()
-        conn.close()
+            self.last_message = outcome['error']
+        return self.last_message
+
+    def _format_sql_results(self, results):
+        lines = []
+        for result in results:
+            statement = ' '.join(result['statement'].split())
+            if len(statement) > 80:
+                statement = statement[:77] + '...'
+            lines.append('%s %.3fs %s rows  %s' % (
+                'ERROR' if result['error'] else 'OK',
+                result['seconds'], result['rowcount'], statement,
+            ))
+            if result['error']:
+                lines.append(result['error'].strip())
+        # Show the rows returned by the last statement, as before
+        if results and results[-1]['rows'] is not None:
+            lines.append(str(results[-1]['rows']))
+        return '\n'.join(lines) or 'Nothing to run'
 
     def setup(self):
-        if not self.setup_script:
-            raise exceptions.ValidationError('Missing setup script')
-        content = interpolate(self.setup_script, self)
-        self._run_sql(content)
+        return self._run_job_now('setup')
 
     def remove(self):
-        if not self.remove_script:
-            raise exceptions.ValidationError('Missing remove script')
-        content = interpolate(self.remove_script, self)
-        self._run_sql(content)
+        return self._run_job_now('remove')
         
\ No newline at end of file
@@ -0,0 +1,273 @@
+import logging
+from concurrent.futures import ThreadPoolExecutor
+from datetime import timedelta
+
+from odoo import models, fields, api, exceptions
+
+from ..tools.jobs import run_plan
+
+_logger = logging.getLogger(__name__)
+
+
+# Operations that may be queued, per model
+JOB_METHODS = {
+    'datacenter.application': (
+        'start', 'stop', 'restart', 'status', 'journal',
+        'install', 'update', 'uninstall',
+    ),
+    'datacenter.app.database': ('setup', 'remove'),
+}
+
+# Remote operations allowed to run at the same time (all servers)
+DEFAULT_MAX_RUNNING = 4
+
+# Base delay in seconds between retries, doubled for every failure
+RETRY_DELAY = 30
+RETRY_DELAY_MAX = 3600
+
+# Running jobs older than this are assumed lost and requeued
+STALE_AFTER = timedelta(hours=2)
+
+
+class DatacenterJob(models.Model):
+    _name = 'datacenter.job'
+    _description = 'Datacenter Job'
+    _order = 'id desc'
+
+    name = fields.Char(string='Name', required=True)
+    res_model = fields.Char(string='Model', required=True, readonly=True)
+    res_id = fields.Integer(string='Record ID', required=True, readonly=True)
+    method = fields.Char(string='Operation', required=True, readonly=True)
+    server_id = fields.Many2one(
+        string='Server', comodel_name='datacenter.app.server',
+        ondelete='cascade', readonly=True,
+    )
+    # Jobs sharing a serial key never run at the same time
+    serial_key = fields.Char(string='Serial Key', index=True, readonly=True)
+
+    state = fields.Selection(
+        string='State', required=True, index=True,
+        selection=[
+            ('queued', 'Queued'),
+            ('running', 'Running'),
+            ('done', 'Done'),
+            ('failed', 'Failed'),
+            ('cancelled', 'Cancelled'),
+        ],
+        default='queued',
+    )
+    attempts = fields.Integer(string='Attempts', default=0, readonly=True)
+    max_attempts = fields.Integer(string='Max Attempts', default=3)
+    date_next = fields.Datetime(
+        string='Next Attempt', index=True, default=fields.Datetime.now,
+    )
+    date_started = fields.Datetime(string='Started', readonly=True)
+    date_done = fields.Datetime(string='Finished', readonly=True)
+    result = fields.Text(string='Result', readonly=True)
+    error = fields.Text(string='Error', readonly=True)
+
+    # Queue an operation on each record and wake up the dispatcher
+    @api.model
+    def enqueue(self, records, method):
+        if method not in JOB_METHODS.get(records._name, ()):
+            raise exceptions.ValidationError(
+                'Operation %s cannot be queued on %s' % (method, records._name))
+        jobs = self.browse()
+        for record in records:
+            # Reuse a job that is already waiting for the same operation
+            job = self.search([
+                ('res_model', '=', record._name), ('res_id', '=', record.id),
+                ('method', '=', method), ('state', 'in', ('queued', 'running')),
+            ], limit=1)
+            if not job:
+                server = record._get_job_server()
+                job = self.create({
+                    'name': '%s: %s' % (record.display_name, method),
+                    'res_model': record._name,
+                    'res_id': record.id,
+                    'method': method,
+                    'server_id': server.id,
+                    'serial_key': '%s,%s' % (server._name, server.id) if server
+                                  else '%s,%s' % (record._name, record.id),
+                })
+            jobs |= job
+        self.env.ref('datacenter.ir_cron_datacenter_job_dispatch')._trigger()
+        return jobs
+
+    # Status polling from the UI or RPC
+    @api.model
+    def poll(self, job_ids):
+        return self.browse(job_ids).exists().read(
+            ['state', 'attempts', 'date_next', 'date_done', 'result', 'error'])
+
+    def cancel(self):
+        self.filtered(lambda j: j.state == 'queued').write({'state': 'cancelled'})
+
+    def requeue(self):
+        self.filtered(lambda j: j.state in ('failed', 'cancelled')).write({
+            'state': 'queued', 'attempts': 0, 'error': False,
+            'date_next': fields.Datetime.now(),
+        })
+        self.env.ref('datacenter.ir_cron_datacenter_job_dispatch')._trigger()
+
+    def _get_max_running(self):
+        return int(self.env['ir.config_parameter'].sudo().get_param(
+            'datacenter.job_max_running', DEFAULT_MAX_RUNNING))
+
+    def _requeue_stale(self):
+        stale = self.search([
+            ('state', '=', 'running'),
+            ('date_started', '<', fields.Datetime.now() - STALE_AFTER),
+        ])
+        if stale:
+            _logger.warning('Requeueing %s stale datacenter jobs', len(stale))
+            stale.write({'state': 'queued', 'date_next': fields.Datetime.now()})
+
+    # Claim the next batch: at most one job per serial key, within the limit
+    def _claim(self):
+        running = self.search([('state', '=', 'running')])
+        slots = self._get_max_running() - len(running)
+        if slots <= 0:
+            return self.browse()
+        busy = set(running.mapped('serial_key'))
+        candidates = self.search([
+            ('state', '=', 'queued'),
+            ('date_next', '<=', fields.Datetime.now()),
+        ], order='date_next, id')
+        claimed = []
+        for job in candidates:
+            if len(claimed) >= slots:
+                break
+            if job.serial_key in busy:
+                continue
+            busy.add(job.serial_key)
+            claimed.append(job.id)
+        if not claimed:
+            return self.browse()
+        # Skip rows another dispatcher already holds
+        self.env.cr.execute(
+            'SELECT id FROM datacenter_job WHERE id IN %s FOR UPDATE SKIP LOCKED',
+            (tuple(claimed),))
+        jobs = self.browse([row[0] for row in self.env.cr.fetchall()])
+        jobs.write({'state': 'running', 'date_started': fields.Datetime.now()})
+        return jobs
+
+    @api.model
+    def _cron_dispatch(self):
+        self._requeue_stale()
+        jobs = self._claim()
+        if not jobs:
+            return
+        # Make the claim visible before the slow remote work starts
+        self.env.cr.commit()
+        with ThreadPoolExecutor(max_workers=len(jobs),
+                                thread_name_prefix='datacenter-job') as executor:
+            for job_id in jobs.ids:
+                executor.submit(self._run_in_new_cursor, job_id)
+        if self.search_count([('state', '=', 'queued')]):
+            self.env.ref('datacenter.ir_cron_datacenter_job_dispatch')._trigger()
+
+    def _run_in_new_cursor(self, job_id):
+        try:
+            with self.pool.cursor() as cr:
+                env = api.Environment(cr, self.env.uid, self.env.context)
+                env[self._name].browse(job_id)._run()
+        except Exception:
+            _logger.exception('Datacenter job %s crashed', job_id)
+
+    def _run(self):
+        self.ensure_one()
+        record = self.env[self.res_model].with_user(self.create_uid).browse(self.res_id).exists()
+        if not record:
+            self.write({'state': 'cancelled', 'error': 'Record no longer exists',
+                        'date_done': fields.Datetime.now()})
+            return
+        attempts = self.attempts + 1
+        # Read everything the remote work needs and commit, so no rows stay
+        # locked and no transaction stays open while waiting on the network
+        try:
+            with self.env.cr.savepoint():
+                plan = record._prepare_job(self.method)
+        except Exception as e:
+            self._retry_or_fail(attempts, str(e) or type(e).__name__)
+            return
+        self.env.cr.commit()
+
+        outcome = run_plan(plan)
+
+        # The result goes in a new short transaction
+        self.invalidate_cache()
+        record = record.exists()
+        if not record:
+            self.write({'state': 'cancelled', 'error': 'Record no longer exists',
+                        'date_done': fields.Datetime.now()})
+            return
+        try:
+            with self.env.cr.savepoint():
+                result = record._apply_job_outcome(self.method, outcome)
+        except Exception as e:
+            self._retry_or_fail(attempts, str(e) or type(e).__name__)
+            return
+        # Non-zero exits, failed checks and SQL errors fail the job
+        if outcome['error']:
+            self._retry_or_fail(attempts, outcome['error'])
+            return
+        self.write({
+            'state': 'done',
+            'attempts': attempts,
+            'error': False,
+            'result': result,
+            'date_done': fields.Datetime.now(),
+        })
+
+    def _retry_or_fail(self, attempts, error):
+        if attempts >= self.max_attempts:
+            self.write({'state': 'failed', 'attempts': attempts, 'error': error,
+                        'date_done': fields.Datetime.now()})
+            return
+        # Back off harder for servers that keep failing
+        failures = max(self.server_id.error_count, attempts) if self.server_id else attempts
+        delay = min(RETRY_DELAY * 2 ** (failures - 1), RETRY_DELAY_MAX)
+        self.write({
+            'state': 'queued', 'attempts': attempts, 'error': error,
+            'date_next': fields.Datetime.now() + timedelta(seconds=delay),
+        })
+
+
+class DatacenterJobMixin(models.AbstractModel):
+    _name = 'datacenter.job.mixin'
+    _description = 'Mixin to queue datacenter operations'
+
+    def _get_job_server(self):
+        return self.env['datacenter.app.server']
+
+    # Read what the operation needs and return a plan for tools.jobs.run_plan
+    def _prepare_job(self, method):
+        raise NotImplementedError()
+
+    # Write the outcome of run_plan back and return the job result
+    def _apply_job_outcome(self, method, outcome):
+        raise NotImplementedError()
+
+    # Run an operation right away in the current transaction
+    def _run_job_now(self, method):
+        self.ensure_one()
+        plan = self._prepare_job(method)
+        self.flush()
+        return self._apply_job_outcome(method, run_plan(plan))
+
+    # Button entry point, the operation comes from the button context
+    def queue_operation(self):
+        method = self.env.context.get('job_method')
+        jobs = self.env['datacenter.job'].enqueue(self, method)
+        return {
+            'type': 'ir.actions.client',
+            'tag': 'display_notification',
+            'params': {
+                'title': 'Queued',
+                'message': '%s queued (%s job%s)' % (
+                    method.capitalize(), len(jobs), '' if len(jobs) == 1 else 's'),
+                'type': 'info',
+                'sticky': False,
+            }
+        }
@@ -0,0 +1,73 @@
+from .ssh_pool import SSH_POOL, CONNECT_TIMEOUT
+from .ssh_exec import run_command, HOST_TIMEOUT
+from .sql import PG_POOL, run_script
+
+
+# Remote part of a datacenter job. The models turn an operation into a plan
+# (plain data read from the ORM), run_plan carries it out with no database
+# transaction open, and the outcome is written back by the models.
+#
+# ssh plan: {'kind': 'ssh', 'params': {host, port, username, pem},
+#            'options': {...run_command options}, 'steps': [step, ...]}
+#   steps: {'op': 'execute', 'command': ...}
+#          {'op': 'status', 'command': ...}
+#          {'op': 'expect_stopped', 'command': ..., 'pattern': ...}
+#          {'op': 'upload', 'path': ..., 'content': ..., 'chmod_exec': bool}
+#   status commands (systemctl status) exit non-zero for stopped services,
+#   so only execute steps fail on their exit status.
+# sql plan: {'kind': 'sql', 'params': {host, port, user, dbname},
+#            'script': ..., 'mode': ...}
+#
+# The outcome is {'results': [...], 'error': None or message}. ssh results
+# are (step, CommandResult or None) pairs, sql results those of run_script.
+
+
+def upload_file(client, path, content, chmod_exec=False):
+    with client.open_sftp() as sftp_client:
+        with sftp_client.open(path, 'w') as remote_file:
+            remote_file.write(content)
+        if chmod_exec:
+            sftp_client.chmod(path, 0o755)
+    return path
+
+
+def run_plan(plan, timeout=HOST_TIMEOUT):
+    try:
+        if plan['kind'] == 'sql':
+            return _run_sql_plan(plan)
+        return _run_ssh_plan(plan, timeout)
+    except Exception as e:
+        return {'results': [], 'error': str(e) or type(e).__name__}
+
+
+def _run_ssh_plan(plan, timeout):
+    params = plan['params']
+    results = []
+    with SSH_POOL.checkout(
+        params['host'], params['port'], params['username'], params['pem'],
+        timeout=min(timeout, CONNECT_TIMEOUT),
+    ) as client:
+        # Steps run in order and stop at the first failure
+        for step in plan['steps']:
+            if step['op'] == 'upload':
+                upload_file(client, step['path'], step['content'], step.get('chmod_exec'))
+                results.append((step, None))
+                continue
+            result = run_command(client, step['command'], timeout=timeout, **plan.get('options', {}))
+            results.append((step, result))
+            if step['op'] == 'execute' and result.exit_status != 0:
+                return {'results': results,
+                        'error': result.stderr or 'Command exited with status %s' % result.exit_status}
+            if step['op'] == 'expect_stopped' and step['pattern'] in (result.stdout or ''):
+                return {'results': results, 'error': 'Application must be stopped first'}
+    return {'results': results, 'error': None}
+
+
+def _run_sql_plan(plan):
+    params = plan['params']
+    with PG_POOL.connection(
+        params['host'], params['port'], params['user'], params['dbname'],
+    ) as conn:
+        results = run_script(conn, plan['script'], plan['mode'])
+    errors = [result['error'] for result in results if result['error']]
+    return {'results': results, 'error': errors[0].strip() if errors else None}
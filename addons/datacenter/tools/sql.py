@@ -0,0 +1,238 @@
+import atexit
+import logging
+import re
+import threading
+import time
+from contextlib import contextmanager
+
+import psycopg2
+from psycopg2.pool import ThreadedConnectionPool, PoolError
+
+_logger = logging.getLogger(__name__)
+
+
+# Connections kept open per (host, port, user, dbname)
+MAX_CONNECTIONS = 4
+
+# Connections idle for longer than this are pinged before being reused
+HEALTH_CHECK_AFTER = 60
+
+CONNECT_TIMEOUT = 15
+
+# Seconds a caller waits for a free connection when all are checked out
+CHECKOUT_TIMEOUT = 60
+
+# Opening tag of a dollar-quoted string: $$ or $tag$
+DOLLAR_TAG = re.compile(r'\$([A-Za-z_][A-Za-z_0-9]*)?\$')
+
+
+def split_sql(script):
+    # Split a script into statements on top-level semicolons only.
+    # Quoted strings (with '' and E'\'' escapes), quoted identifiers,
+    # dollar-quoted bodies ($$ or $tag$), -- comments and nested /* */
+    # comments are skipped over, so functions and DO blocks stay whole.
+    statements = []
+    start = 0
+    i = 0
+    length = len(script)
+    has_code = False
+    while i < length:
+        char = script[i]
+        if char == '-' and script.startswith('--', i):
+            end = script.find('\n', i)
+            i = length if end == -1 else end + 1
+            continue
+        if char == '/' and script.startswith('/*', i):
+            depth = 0
+            while i < length:
+                if script.startswith('/*', i):
+                    depth += 1
+                    i += 2
+                elif script.startswith('*/', i):
+                    depth -= 1
+                    i += 2
+                    if not depth:
+                        break
+                else:
+                    i += 1
+            continue
+        if char == ';':
+            if has_code:
+                statements.append(script[start:i].strip())
+            start = i + 1
+            has_code = False
+            i += 1
+            continue
+        if not char.isspace():
+            has_code = True
+        if char == "'":
+            escapes = i > 0 and script[i - 1] in 'eE' and (
+                i < 2 or not (script[i - 2].isalnum() or script[i - 2] == '_'))
+            i += 1
+            while i < length:
+                if escapes and script[i] == '\\':
+                    i += 2
+                    continue
+                if script[i] == "'":
+                    if script.startswith("''", i):
+                        i += 2
+                        continue
+                    break
+                i += 1
+            i += 1
+            continue
+        if char == '"':
+            end = script.find('"', i + 1)
+            while end != -1 and script.startswith('""', end):
+                end = script.find('"', end + 2)
+            i = length if end == -1 else end + 1
+            continue
+        if char == '$' and (i == 0 or not (script[i - 1].isalnum() or script[i - 1] == '_')):
+            match = DOLLAR_TAG.match(script, i)
+            if match:
+                tag = match.group(0)
+                end = script.find(tag, match.end())
+                i = length if end == -1 else end + len(tag)
+                continue
+        i += 1
+    if has_code:
+        statements.append(script[start:].strip())
+    return statements
+
+
+class PgConnectionPool:
+    # psycopg2 pools keyed by endpoint, port, user and database
+
+    def __init__(self, maxconn=MAX_CONNECTIONS):
+        self.maxconn = maxconn
+        self._pools = {}
+        # One slot per connection of each pool: getconn() raises instead of
+        # waiting when maxconn connections are out, callers queue here
+        self._slots = {}
+        self._last_used = {}
+        self._lock = threading.Lock()
+
+    def _get_pool(self, key):
+        with self._lock:
+            pool = self._pools.get(key)
+            if pool is None:
+                host, port, user, dbname = key
+                pool = ThreadedConnectionPool(
+                    0, self.maxconn,
+                    host=host, port=port, user=user, dbname=dbname,
+                    connect_timeout=CONNECT_TIMEOUT,
+                )
+                self._pools[key] = pool
+                self._slots[key] = threading.BoundedSemaphore(self.maxconn)
+            return pool, self._slots[key]
+
+    def _is_healthy(self, conn):
+        if conn.closed:
+            return False
+        if time.monotonic() - self._last_used.get(id(conn), 0) < HEALTH_CHECK_AFTER:
+            return True
+        try:
+            with conn.cursor() as cur:
+                cur.execute('SELECT 1')
+            conn.rollback()
+            return True
+        except psycopg2.Error:
+            return False
+
+    @contextmanager
+    def connection(self, host, port, user, dbname, autocommit=True,
+                   timeout=CHECKOUT_TIMEOUT):
+        key = (host, int(port or 5432), user, dbname)
+        pool, slots = self._get_pool(key)
+        if not slots.acquire(timeout=timeout):
+            raise PoolError('No free connection to %s:%s after %ss' % (host, key[1], timeout))
+        try:
+            conn = pool.getconn()
+            if not self._is_healthy(conn):
+                pool.putconn(conn, close=True)
+                conn = pool.getconn()
+        except Exception:
+            slots.release()
+            raise
+        broken = False
+        try:
+            conn.autocommit = autocommit
+            yield conn
+        except (psycopg2.OperationalError, psycopg2.InterfaceError):
+            broken = True
+            raise
+        finally:
+            if not conn.closed and not broken:
+                if not conn.autocommit:
+                    conn.rollback()
+                conn.autocommit = True
+            self._last_used[id(conn)] = time.monotonic()
+            try:
+                pool.putconn(conn, close=broken or bool(conn.closed))
+            finally:
+                slots.release()
+
+    def close_all(self):
+        with self._lock:
+            pools = list(self._pools.values())
+            self._pools.clear()
+            self._slots.clear()
+            self._last_used.clear()
+        for pool in pools:
+            pool.closeall()
+
+
+PG_POOL = PgConnectionPool()
+atexit.register(PG_POOL.close_all)
+
+
+def _statement_result(cur, statement, started, error=None):
+    result = {
+        'statement': statement,
+        'seconds': time.perf_counter() - started,
+        'rowcount': cur.rowcount if error is None else -1,
+        'rows': None,
+        'error': error,
+    }
+    if error is None and cur.description is not None:
+        result['rows'] = cur.fetchall()
+    return result
+
+
+def run_script(conn, script, mode='statement'):
+    # Run a script over an open connection and return one result per
+    # statement: statement, seconds, rowcount, rows (if any) and error.
+    #   statement:   each statement on its own, errors do not stop the run
+    #   transaction: all statements in one transaction, stops at the first
+    #                error and rolls everything back
+    #   batch:       the whole script in a single round trip and transaction.
+    #                The server runs it as one command, so there is a single
+    #                result timing the whole script, not one per statement.
+    results = []
+    with conn.cursor() as cur:
+        if mode == 'batch':
+            conn.autocommit = False
+            started = time.perf_counter()
+            try:
+                cur.execute(script)
+                results.append(_statement_result(cur, script.strip(), started))
+                conn.commit()
+            except psycopg2.Error as e:
+                conn.rollback()
+                results.append(_statement_result(cur, script.strip(), started, str(e)))
+            return results
+
+        conn.autocommit = mode != 'transaction'
+        for statement in split_sql(script):
+            started = time.perf_counter()
+            try:
+                cur.execute(statement)
+                results.append(_statement_result(cur, statement, started))
+            except psycopg2.Error as e:
+                results.append(_statement_result(cur, statement, started, str(e)))
+                if mode == 'transaction':
+                    conn.rollback()
+                    return results
+        if mode == 'transaction':
+            conn.commit()
+    return results
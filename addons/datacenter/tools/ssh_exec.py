@@ -0,0 +1,174 @@
+import logging
+import socket
+import time
+import zlib
+from collections import deque, namedtuple
+from concurrent.futures import ThreadPoolExecutor, wait
+
+from .ssh_pool import SSH_POOL, CONNECT_TIMEOUT
+
+_logger = logging.getLogger(__name__)
+
+
+# Default seconds a single host may take to connect and run a command
+HOST_TIMEOUT = 300
+
+# Default number of hosts contacted at the same time by run_many
+MAX_WORKERS = 16
+
+# Default bytes of stdout/stderr kept in memory (the tail of the output)
+OUTPUT_LIMIT = 64 * 1024
+
+# Bytes read from a channel at a time
+CHUNK_SIZE = 32 * 1024
+
+# Bounds of the sleep between polls of an idle channel
+POLL_MIN = 0.005
+POLL_MAX = 0.2
+
+
+CommandResult = namedtuple(
+    'CommandResult', ['stdout', 'stderr', 'exit_status', 'truncated', 'log'],
+)
+
+
+class TailBuffer:
+    # Ring buffer that keeps only the last max_bytes written to it.
+    # A max_bytes of 0 keeps everything.
+
+    def __init__(self, max_bytes=OUTPUT_LIMIT):
+        self.max_bytes = max_bytes
+        self.total = 0
+        self._chunks = deque()
+        self._size = 0
+
+    def write(self, data):
+        self.total += len(data)
+        self._chunks.append(data)
+        self._size += len(data)
+        if not self.max_bytes:
+            return
+        while self._size > self.max_bytes:
+            excess = self._size - self.max_bytes
+            head = self._chunks[0]
+            if len(head) <= excess:
+                self._chunks.popleft()
+                self._size -= len(head)
+            else:
+                self._chunks[0] = head[excess:]
+                self._size -= excess
+
+    @property
+    def truncated(self):
+        return self.total > self._size
+
+    def getvalue(self):
+        return b''.join(self._chunks)
+
+    def text(self):
+        text = self.getvalue().decode('utf-8', errors='replace')
+        if self.truncated:
+            text = '[... %s bytes truncated ...]\n%s' % (self.total - self._size, text)
+        return text
+
+
+def run_command(client, command, timeout=None, max_bytes=OUTPUT_LIMIT, keep_log=False):
+    # Run a command over an open client, draining stdout and stderr together
+    # so neither channel window can fill up and stall the remote process.
+    # Only the tail of each stream is kept; with keep_log the interleaved
+    # output is also gzip-compressed on the fly into result.log.
+    stdout, stderr = TailBuffer(max_bytes), TailBuffer(max_bytes)
+    compressor = zlib.compressobj(wbits=31) if keep_log else None
+    log = []
+    deadline = time.monotonic() + timeout if timeout else None
+
+    channel = client.get_transport().open_session()
+    try:
+        channel.exec_command(command)
+        delay = POLL_MIN
+        while True:
+            received = False
+            while channel.recv_ready():
+                data = channel.recv(CHUNK_SIZE)
+                stdout.write(data)
+                if compressor:
+                    log.append(compressor.compress(data))
+                received = True
+            while channel.recv_stderr_ready():
+                data = channel.recv_stderr(CHUNK_SIZE)
+                stderr.write(data)
+                if compressor:
+                    log.append(compressor.compress(data))
+                received = True
+            if (channel.exit_status_ready() and not channel.recv_ready()
+                    and not channel.recv_stderr_ready()):
+                break
+            if received:
+                delay = POLL_MIN
+                continue
+            if deadline and time.monotonic() > deadline:
+                raise socket.timeout('Command timed out after %ss' % timeout)
+            time.sleep(delay)
+            delay = min(delay * 2, POLL_MAX)
+        exit_status = channel.recv_exit_status()
+    finally:
+        channel.close()
+
+    if compressor:
+        log.append(compressor.flush())
+    return CommandResult(
+        stdout=stdout.text(),
+        stderr=stderr.text(),
+        exit_status=exit_status,
+        truncated=stdout.truncated or stderr.truncated,
+        log=b''.join(log) if compressor else None,
+    )
+
+
+def run_on_host(params, command, timeout=HOST_TIMEOUT, **options):
+    # params: dict with host, port, username and pem, read beforehand
+    # so that this function never touches the ORM.
+    with SSH_POOL.checkout(
+        params['host'], params['port'], params['username'], params['pem'],
+        timeout=min(timeout, CONNECT_TIMEOUT),
+    ) as client:
+        return run_command(client, command, timeout=timeout, **options)
+
+
+def run_many(jobs, timeout=HOST_TIMEOUT, max_workers=MAX_WORKERS):
+    # jobs: {key: (params, command, options)}, options go to run_command.
+    # Returns {key: (result, error)} where error is None on success. Hosts
+    # still running at the deadline get their pooled connection closed.
+    results = {}
+    if not jobs:
+        return results
+    workers = max(1, min(max_workers, len(jobs)))
+    executor = ThreadPoolExecutor(
+        max_workers=workers, thread_name_prefix='datacenter-ssh',
+    )
+    futures = {
+        executor.submit(run_on_host, params, command, timeout, **options): key
+        for key, (params, command, options) in jobs.items()
+    }
+    try:
+        # Hosts run in waves of max_workers, each bounded by timeout.
+        # The command deadline normally trips first, this is the backstop.
+        waves = -(-len(jobs) // workers)
+        done, not_done = wait(futures, timeout=timeout * waves + CONNECT_TIMEOUT)
+        for future in done:
+            key = futures[future]
+            try:
+                results[key] = (future.result(), None)
+            except Exception as e:
+                results[key] = (None, str(e) or type(e).__name__)
+        for future in not_done:
+            key = futures[future]
+            if not future.cancel():
+                # Still running: closing its connection makes the command
+                # fail at once, so the thread ends and gives the slot back
+                params = jobs[key][0]
+                SSH_POOL.close(params['host'], params['port'], params['username'], params['pem'])
+            results[key] = (None, 'Timed out after %ss' % timeout)
+    finally:
+        executor.shutdown(wait=False)
+    return results
@@ -0,0 +1,215 @@
+import atexit
+import hashlib
+import logging
+import threading
+import time
+from collections import OrderedDict
+from contextlib import contextmanager
+from io import StringIO
+
+from paramiko import SSHClient, AutoAddPolicy, RSAKey
+
+_logger = logging.getLogger(__name__)
+
+
+# Seconds between keepalive packets sent on pooled transports
+KEEPALIVE_INTERVAL = 30
+
+# Pooled connections unused for this many seconds are closed, connections
+# checked out by a caller are never evicted however long their command runs
+IDLE_TIMEOUT = 300
+
+# Reused connections idle for longer than this are probed before use
+HEALTH_CHECK_AFTER = 15
+
+# Seconds allowed for the TCP connect and SSH handshake
+CONNECT_TIMEOUT = 15
+
+# Number of parsed private keys kept in memory
+KEY_CACHE_SIZE = 64
+
+
+def pem_digest(pem):
+    return hashlib.sha256(pem.encode('utf-8')).hexdigest()
+
+
+class RSAKeyCache:
+    # Parsed RSAKey objects keyed by the digest of the PEM text.
+    # A changed PEM hashes to a new key, so stale entries are never returned
+    # and simply age out of the LRU (or are dropped with discard).
+
+    def __init__(self, maxsize=KEY_CACHE_SIZE):
+        self.maxsize = maxsize
+        self._keys = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, pem):
+        digest = pem_digest(pem)
+        with self._lock:
+            if digest in self._keys:
+                self._keys.move_to_end(digest)
+                return self._keys[digest]
+        private_key = RSAKey.from_private_key(StringIO(pem))
+        with self._lock:
+            self._keys[digest] = private_key
+            while len(self._keys) > self.maxsize:
+                self._keys.popitem(last=False)
+        return private_key
+
+    def discard(self, pem):
+        with self._lock:
+            self._keys.pop(pem_digest(pem), None)
+
+    def clear(self):
+        with self._lock:
+            self._keys.clear()
+
+
+class _PooledConnection:
+
+    def __init__(self, client):
+        self.client = client
+        self.last_used = time.monotonic()
+        # Number of callers currently holding the client, guarded by the pool lock
+        self.in_use = 0
+
+    def idle_time(self):
+        return time.monotonic() - self.last_used
+
+    def is_healthy(self):
+        transport = self.client.get_transport()
+        if transport is None or not transport.is_active():
+            return False
+        if self.idle_time() > HEALTH_CHECK_AFTER:
+            # Cheap round trip that fails fast on a dead peer
+            try:
+                transport.send_ignore()
+            except Exception:
+                return False
+        return True
+
+    def close(self):
+        try:
+            self.client.close()
+        except Exception:
+            _logger.debug('Error closing pooled SSH connection', exc_info=True)
+
+
+class SSHConnectionPool:
+    # One live SSH transport per (host, port, user, key) tuple.
+    # Callers must not close the returned client: channels and SFTP sessions
+    # opened on it are multiplexed over the same transport.
+
+    def __init__(self, key_cache=None, idle_timeout=IDLE_TIMEOUT):
+        self.key_cache = key_cache or RSAKeyCache()
+        self.idle_timeout = idle_timeout
+        self._connections = {}
+        self._connect_locks = {}
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def make_key(host, port, username, pem):
+        return (host, int(port or 22), username, pem_digest(pem))
+
+    @contextmanager
+    def checkout(self, host, port, username, pem, timeout=CONNECT_TIMEOUT):
+        # with pool.checkout(...) as client: the connection counts as in use
+        # until the block exits, so idle eviction leaves it alone
+        conn = self._acquire(host, port, username, pem, timeout)
+        try:
+            yield conn.client
+        finally:
+            with self._lock:
+                conn.in_use -= 1
+                conn.last_used = time.monotonic()
+
+    def _acquire(self, host, port, username, pem, timeout):
+        pool_key = self.make_key(host, port, username, pem)
+        self.evict_idle()
+        # Serialize connects per key so concurrent callers share one handshake
+        # without blocking callers of other hosts.
+        with self._lock:
+            connect_lock = self._connect_locks.setdefault(pool_key, threading.Lock())
+        with connect_lock:
+            with self._lock:
+                conn = self._connections.get(pool_key)
+            if conn is not None:
+                if conn.is_healthy():
+                    with self._lock:
+                        conn.in_use += 1
+                        conn.last_used = time.monotonic()
+                    return conn
+                _logger.info('Dropping stale SSH connection to %s:%s', host, port)
+                self._remove(pool_key, conn)
+            client = self._connect(host, port, username, pem, timeout)
+            with self._lock:
+                conn = self._connections.get(pool_key)
+                if conn is None:
+                    conn = self._connections[pool_key] = _PooledConnection(client)
+                    client = None
+                conn.in_use += 1
+            if client is not None:
+                # Another caller connected through a pruned lock meanwhile
+                client.close()
+            return conn
+
+    def _connect(self, host, port, username, pem, timeout):
+        private_key = self.key_cache.get(pem)
+        client = SSHClient()
+        client.set_missing_host_key_policy(AutoAddPolicy())
+        client.connect(
+            hostname=host, port=int(port or 22),
+            username=username, pkey=private_key,
+            timeout=timeout, banner_timeout=timeout, auth_timeout=timeout,
+        )
+        client.get_transport().set_keepalive(KEEPALIVE_INTERVAL)
+        _logger.info('Opened SSH connection to %s@%s:%s', username, host, port)
+        return client
+
+    def _remove(self, pool_key, conn=None):
+        with self._lock:
+            current = self._connections.get(pool_key)
+            if conn is None or current is conn:
+                self._connections.pop(pool_key, None)
+                conn = current
+        if conn is not None:
+            conn.close()
+
+    # Close the connection to a host, channels open on it fail at once.
+    # Callers holding it release it normally, a new one is opened on demand.
+    def close(self, host, port, username, pem):
+        self._remove(self.make_key(host, port, username, pem))
+
+    def discard(self, host, port, username, pem):
+        self._remove(self.make_key(host, port, username, pem))
+        self.key_cache.discard(pem)
+
+    def evict_idle(self):
+        with self._lock:
+            expired = [
+                (pool_key, conn) for pool_key, conn in self._connections.items()
+                if not conn.in_use and conn.idle_time() > self.idle_timeout
+            ]
+            for pool_key, _conn in expired:
+                del self._connections[pool_key]
+                lock = self._connect_locks.get(pool_key)
+                if lock is not None and not lock.locked():
+                    del self._connect_locks[pool_key]
+        for _pool_key, conn in expired:
+            conn.close()
+        return len(expired)
+
+    def close_all(self):
+        with self._lock:
+            connections = list(self._connections.values())
+            self._connections.clear()
+        for conn in connections:
+            conn.close()
+
+    def __len__(self):
+        return len(self._connections)
+
+
+# Process-wide pool shared by every AppServer record
+SSH_POOL = SSHConnectionPool()
+atexit.register(SSH_POOL.close_all)
@@ -0,0 +1,128 @@
+import hashlib
+import re
+import threading
+from collections import OrderedDict
+
+
+# A token looks like %[name] or %[dotted.path]
+TOKEN_PATTERN = re.compile(r'%\[([\w\.]+)\]')
+
+# Number of compiled templates kept in memory
+CACHE_SIZE = 512
+
+
+class TemplateError(ValueError):
+    pass
+
+
+class TemplateCycleError(TemplateError):
+    pass
+
+
+class Template:
+    # A script parsed once into alternating literals and token paths:
+    # parts[0], parts[2], ... are literal text and parts[1], parts[3], ...
+    # are tuples with the dotted path of each token.
+
+    __slots__ = ('source', 'parts')
+
+    def __init__(self, source):
+        self.source = source
+        parts = []
+        position = 0
+        for match in TOKEN_PATTERN.finditer(source):
+            parts.append(source[position:match.start()])
+            parts.append(tuple(match.group(1).split('.')))
+            position = match.end()
+        parts.append(source[position:])
+        self.parts = parts
+
+    @property
+    def paths(self):
+        return self.parts[1::2]
+
+    def render(self, data, _values=None, _stack=()):
+        if len(self.parts) == 1:
+            return self.source
+        # Each path is resolved once per render, nested or not
+        values = {} if _values is None else _values
+        output = []
+        for index, part in enumerate(self.parts):
+            if not index % 2:
+                output.append(part)
+                continue
+            if part in _stack:
+                raise TemplateCycleError('Template cycle: %s' % ' -> '.join(
+                    '.'.join(path) for path in _stack + (part,)))
+            if part not in values:
+                values[part] = self._render_value(part, data, values, _stack)
+            output.append(values[part])
+        return ''.join(output)
+
+    def _render_value(self, path, data, values, stack):
+        value = resolve_path(data, path)
+        if value is None:
+            # Unknown tokens are left untouched
+            return '%%[%s]' % '.'.join(path)
+        value = str(value)
+        if '%[' not in value:
+            return value
+        # Values may contain tokens themselves, render them with this path
+        # on the stack so self-references are caught instead of looping.
+        return compile_template(value).render(data, values, stack + (path,))
+
+
+def resolve_path(data, path):
+    # Walk a dotted path over dicts, records or any other object
+    value = data
+    for key in path:
+        if value is None:
+            return None
+        if isinstance(value, dict):
+            value = value.get(key)
+        else:
+            value = getattr(value, key, None)
+    return value
+
+
+class TemplateCache:
+    # Compiled templates keyed by the digest of their source, LRU evicted
+
+    def __init__(self, maxsize=CACHE_SIZE):
+        self.maxsize = maxsize
+        self._templates = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, text):
+        digest = hashlib.sha1(text.encode('utf-8')).digest()
+        with self._lock:
+            template = self._templates.get(digest)
+            if template is not None:
+                self._templates.move_to_end(digest)
+                return template
+        template = Template(text)
+        with self._lock:
+            self._templates[digest] = template
+            while len(self._templates) > self.maxsize:
+                self._templates.popitem(last=False)
+        return template
+
+    def clear(self):
+        with self._lock:
+            self._templates.clear()
+
+    def __len__(self):
+        return len(self._templates)
+
+
+TEMPLATE_CACHE = TemplateCache()
+
+
+def compile_template(text):
+    return TEMPLATE_CACHE.get(text)
+
+
+def render(text, data):
+    if not text:
+        return text
+    return compile_template(text).render(data)
@@ -1,6 +1,6 @@
 {
     'name': 'Site Inspection',
-    'version': '1.1.12',
+    'version': '1.1.27',
     'category': 'Productivity',
     'summary': 'Store on-site inspection data to generate reports and estimates.',
     'sequence': 9,
@@ -16,9 +16,12 @@
         # XML, CSV, and YML files, etc. that you want to include
         'views/general_inspection_view.xml',
         'views/electrical_inspection_view.xml',
+        'views/inspection_report_view.xml',
+        'views/inspection_report_templates.xml',
         'views/inspection_menu.xml',
         'security/groups.xml',
         'security/ir.model.access.csv', 
+        'data/inspection_cron.xml',
     ],
     'demo': [],
     'installable': True,
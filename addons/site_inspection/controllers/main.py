@@ -0,0 +1,17 @@
+from odoo import http
+from odoo.http import request
+
+
+class InspectionSyncController(http.Controller):
+
+    # Offline field capture: the client posts every draft captured since
+    # its last sync with the token it got back then, and receives the
+    # upload results plus the server side changes in the same answer.
+    @http.route('/site_inspection/sync', type='json', auth='user', methods=['POST'])
+    def sync(self, inspections=None, token=0, **kwargs):
+        try:
+            token = int(token or 0)
+        except (TypeError, ValueError):
+            token = 0
+        return request.env['electrical.inspection.record']._sync_from_client(
+            inspections or [], token)
@@ -1 +1,5 @@
 from . import inspection
+from . import circuit
+from . import report
+from . import sync
+from . import report_pdf
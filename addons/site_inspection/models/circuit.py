@@ -0,0 +1,118 @@
+import logging
+from odoo import models, fields, api, exceptions
+
+from ..tools.circuit import CircuitSolver, Segment
+from ..tools.sizing import all_gauges
+
+_logger = logging.getLogger(__name__)
+
+
+# Circuit of an electrical inspection: feeders from the supply to panels and
+# from panels to the charger runs. Inspections with segments are sized as a
+# whole circuit, the others as the single run described by their distance.
+
+class ElectricalSegment(models.Model):
+
+    _name = 'electrical.inspection.segment'
+    _description = 'Electrical Inspection Segment'
+    _order = 'inspection_id, sequence, id'
+
+    inspection_id = fields.Many2one(
+        'electrical.inspection.record', string='Inspection',
+        required=True, ondelete='cascade', index=True)
+    sequence = fields.Integer(string='Sequence', default=10)
+    name = fields.Char(string='Name', required=True)
+    kind = fields.Selection([
+        ('feeder', 'Feeder'),
+        ('panel', 'Panel'),
+        ('branch', 'Charger Run'),
+    ], string='Kind', default='branch', required=True)
+    parent_id = fields.Many2one(
+        'electrical.inspection.segment', string='Fed From', ondelete='cascade', index=True,
+        domain="[('inspection_id', '=', inspection_id)]",
+        help='Leave empty for segments fed directly from the supply')
+    child_ids = fields.One2many('electrical.inspection.segment', 'parent_id', string='Feeds')
+    length = fields.Float(string='Length (m)')
+    num_chargers = fields.Integer(
+        string='Chargers', default=0,
+        help='Chargers connected at the end of this segment')
+
+    # Results of the last calculation
+    cable_size = fields.Selection(selection='_get_cable_sizes', string='Cable Size', readonly=True)
+    current = fields.Float(string='Current (A)', readonly=True)
+    voltage_drop = fields.Float(string='Drop (%)', digits=(16, 2), readonly=True)
+    cumulative_drop = fields.Float(string='Total Drop (%)', digits=(16, 2), readonly=True)
+
+    def _get_cable_sizes(self):
+        return [(gauge, f'{gauge} AWG') for gauge in all_gauges()]
+
+    @api.constrains('parent_id')
+    def _check_parent(self):
+        if not self._check_recursion():
+            raise exceptions.ValidationError('A segment cannot feed itself')
+        for record in self:
+            if record.parent_id and record.parent_id.inspection_id != record.inspection_id:
+                raise exceptions.ValidationError('Segments must belong to the same inspection')
+
+
+class ElectricalInspectionCircuit(models.Model):
+
+    _inherit = 'electrical.inspection.record'
+
+    segment_ids = fields.One2many('electrical.inspection.segment', 'inspection_id', string='Circuit')
+
+    # Size every segment of the circuit of each record with the circuit
+    # solver, the cheapest gauges keeping the drop to every charger within
+    # 3%. The record's cable and pipe are those of its largest supply run.
+    # Returns {record id: error} like _calculate_sizing.
+    def _calculate_circuit(self) -> dict:
+        errors, segment_groups, record_groups = {}, {}, {}
+        for record in self:
+            if not record.cable_material or not record.supply_voltage:
+                errors[record.id] = 'Cable material and supply voltage must be defined'
+                continue
+            engine = record._get_sizing_engine()
+            roots = record._get_circuit()
+            result = CircuitSolver(
+                engine, record.cable_material, record.temperature_rating,
+                int(record.supply_voltage), record.num_cables,
+            ).solve(roots)
+            if result.error:
+                errors[record.id] = result.error
+                continue
+            # Identical runs get identical results, they share one write
+            for segment_id, segment in result.segments.items():
+                vals = (
+                    ('cable_size', segment.gauge),
+                    ('current', segment.current),
+                    ('voltage_drop', segment.drop),
+                    ('cumulative_drop', segment.cumulative_drop),
+                )
+                segment_groups.setdefault(vals, []).append(segment_id)
+            main = max(roots, key=lambda root: root.current)
+            gauge = result.segments[main.key].gauge
+            if not (pipe_size := engine.conduit_for(gauge, record.num_cables)):
+                errors[record.id] = 'No suitable pipe size found'
+                continue
+            record_groups.setdefault((gauge, pipe_size), []).append(record.id)
+        Segments = self.env['electrical.inspection.segment']
+        for vals, segment_ids in segment_groups.items():
+            Segments.browse(segment_ids).write(dict(vals))
+        for (cable_size, pipe_size), ids in record_groups.items():
+            self.browse(ids).write({'cable_size': cable_size, 'pipe_size': pipe_size})
+        _logger.info(f'Solved {len(self) - len(errors)} circuits, {len(errors)} failed')
+        return errors
+
+    # Segment trees of the circuit, one root per run from the supply
+    def _get_circuit(self) -> list:
+        nodes = {
+            segment.id: Segment(segment.id, segment.length, segment.num_chargers * self.amperage)
+            for segment in self.segment_ids
+        }
+        roots = []
+        for segment in self.segment_ids:
+            if segment.parent_id.id in nodes:
+                nodes[segment.parent_id.id].children.append(nodes[segment.id])
+            else:
+                roots.append(nodes[segment.id])
+        return roots
@@ -1,6 +1,11 @@
 import logging
 import math
-from odoo import models, fields, exceptions
+from odoo import models, fields, api, exceptions
+
+from ..tools.sizing import (
+    AMPACITY_TABLES, CONDUIT_SIZES_INCHES, DEFAULT_TABLE, SizingRun,
+    all_gauges, get_engine,
+)
 
 _logger = logging.getLogger(__name__)
 
@@ -17,6 +22,7 @@ class Inspection(models.Model):
     
     _name = 'inspection.record'
     _description = 'General Inspection'
+    _rec_name = 'name'
 
     # Purpose of the inspection
     purpose = fields.Selection([
@@ -50,66 +56,29 @@ class Inspection(models.Model):
     planner_notes = fields.Text(string='Planner Notes')
 
     # Name for the inspection = customer name + short date
-    def name_get(self):
-        result = []
+    # Stored and trigram indexed so name searches and many2one
+    # dropdowns are a single indexed query
+    name = fields.Char(
+        string='Name', compute='_compute_name', store=True, index='trigram')
+
+    @api.depends('customer_id.name', 'date')
+    def _compute_name(self):
         for record in self:
-            name = f'{record.customer_id.name} - {record.date}'
-            result.append((record.id, name))
-        return result
+            record.name = f'{record.customer_id.name or ""} - {record.date or ""}'
+
+    @api.model
+    def _name_search(self, name, args=None, operator='ilike', limit=100, name_get_uid=None):
+        domain = list(args or [])
+        if name:
+            domain += [('name', operator, name)]
+        return self._search(domain, limit=limit, access_rights_uid=name_get_uid)
 
 
 # Electrical Inspection Model
 # This applies to inspections of electrical systems
 
-# First we setup an AWG table for the cable sizes
-# C = Copper, A = Aluminum
-# 60 = 60C, 75 = 75C, 90 = 90C
-# The values are the Ampacity of the cable
-# The values are based on the NEC 2017 Table 310.15(B)(16)
-
-AWG_TEMP_AMPACITY = {
-    '10': {'C60': 30, 'C75': 35, 'C90': 40, 'A75': 30, 'A90': 35},
-    '8': {'C60': 40, 'C75': 50, 'C90': 55, 'A75': 40, 'A90': 45},
-    '6': {'C60': 55, 'C75': 65, 'C90': 75, 'A75': 50, 'A90': 55},
-    '4': {'C60': 70, 'C75': 85, 'C90': 95, 'A75': 65, 'A90': 75},
-    '3': {'C60': 85, 'C75': 100, 'C90': 115, 'A75': 75, 'A90': 85},
-    '2': {'C60': 95, 'C75': 115, 'C90': 130, 'A75': 90, 'A90': 100},
-    '1': {'C60': 0, 'C75': 130, 'C90': 145, 'A75': 100, 'A90': 115},
-    '1/0': {'C60': 0, 'C75': 150, 'C90': 170, 'A75': 120, 'A90': 135},
-    '2/0': {'C60': 0, 'C75': 175, 'C90': 195, 'A75': 135, 'A90': 150},
-    '3/0': {'C60': 0, 'C75': 200, 'C90': 225, 'A75': 155, 'A90': 175},
-    '4/0': {'C60': 0, 'C75': 230, 'C90': 260, 'A75': 180, 'A90': 205},
-}
-
-
-# Resistivity of copper and aluminum
-RESISTIVITY = {'C': 1.68e-8, 'A': 2.82e-8}
-
-
-AWG_DIAMETER_INCHES = {
-    '4/0': 0.46,
-    '3/0': 0.4096,
-    '2/0': 0.3648,
-    '1/0': 0.3249,
-    '1': 0.2893,
-    '2': 0.2576,
-    '3': 0.2294,
-    '4': 0.2043,
-    '6': 0.162,
-    '8': 0.1285,
-    '10': 0.1019,
-}
-
-CONDUIT_SIZES_INCHES = {
-    '1/2': 0.5,
-    '3/4': 0.75,
-    '1': 1.0,
-    '1 1/4': 1.25,
-    '1 1/2': 1.5,
-    '2': 2.0,
-    '2 1/2': 2.5,
-}
-
+# The cable and conduit tables live in tools/sizing.py together with the
+# sizing engine that uses them.
 
 class ElectricalInspection(models.Model):
     
@@ -153,10 +122,12 @@ class ElectricalInspection(models.Model):
         ('90', '90C'),
     ], string='Temp. Rating', default='60')
 
+    # Ampacity table used for sizing, see tools/sizing.py to add more
+    ampacity_table = fields.Selection(
+        selection='_get_ampacity_tables', string='Ampacity Table', default=DEFAULT_TABLE)
+
     turns = fields.Integer(string='Turns')
-    cable_size = fields.Selection([
-        (key, f'{key} AWG') for key in AWG_TEMP_AMPACITY.keys()
-    ], string='Cable Size')
+    cable_size = fields.Selection(selection='_get_cable_sizes', string='Cable Size')
     
     # Sizing for the pipes that will contain the cable
     pipe_size = fields.Selection([
@@ -175,67 +146,90 @@ class ElectricalInspection(models.Model):
 
     sales_order_id = fields.Many2one('sale.order', string='Sales Order')
 
+    def _get_ampacity_tables(self):
+        return [(code, table['name']) for code, table in AMPACITY_TABLES.items()]
+
+    def _get_cable_sizes(self):
+        return [(gauge, f'{gauge} AWG') for gauge in all_gauges()]
+
+    # The three actions below work on any number of records, from the form
+    # buttons or from the list view server actions. Each record is checked
+    # on its own, errors are collected instead of stopping the batch and
+    # statuses are written with one write per status.
+
     def validations(self) -> None:
-        error_msg = None
-        try:
-            self._validate_observations()
-            self.status = 'validated'
-        except Exception as error:
-            error_msg = error.args[0]
-            self.status = 'pending'
-        return {
-            'type': 'ir.actions.client',
-            'tag': 'display_notification',
-            'params': {
-                'title': 'Checks Passed' if not error_msg else 'Checks Failed',
-                'message': 'Proceed to calculations.' if not error_msg else error_msg,
-                'type': 'success' if not error_msg else 'danger',
-                'sticky': False,
-            }
-        }
+        errors = {}
+        for record in self:
+            try:
+                record._validate_observations()
+            except Exception as error:
+                errors[record.id] = error.args[0]
+        self._write_status(errors, 'validated', 'pending')
+        return self._get_batch_notification(
+            errors, 'Checks Passed', 'Checks Failed', 'Proceed to calculations.')
 
     def calculations(self) -> None:
-        try:
-            self._calculate_cable()
-            self._calculate_pipe()
-            self._validate_calculation()
-            self.status = 'calculated'
-        except Exception as error:
-            self.status = 'validated'
+        circuits = self.filtered('segment_ids')
+        errors = (self - circuits)._calculate_sizing()
+        errors.update(circuits._calculate_circuit())
+        for record in self.filtered(lambda r: r.id not in errors):
+            try:
+                record._validate_calculation()
+            except Exception as error:
+                errors[record.id] = error.args[0]
+        self._write_status(errors, 'calculated', 'validated')
+        if not errors:
             return {
                 'type': 'ir.actions.client',
-                'tag': 'display_notification',
-                'params': {
-                    'title': 'Calculate Failed',
-                    'message': error.args[0],
-                    'type': 'danger',
-                    'sticky': False,
-                }
+                'tag': 'reload',
             }
-        return {
-            'type': 'ir.actions.client',
-            'tag': 'reload',
-        }
-
-    def draft_quote(self) -> None:
-        try:
-            self._draft_sales_order()
-            self.status = 'drafted'
-        except Exception as error:
-            self.status = 'calculated'
+        return self._get_batch_notification(
+            errors, 'Calculated', 'Calculate Failed', 'Cable and pipe sized.')
+
+    # With merge, inspections of the same customer share one quote
+    def draft_quote(self, merge=False) -> None:
+        errors = self._draft_sales_orders(merge=merge)
+        self._write_status(errors, 'drafted', 'calculated')
+        if not errors:
             return {
                 'type': 'ir.actions.client',
-                'tag': 'display_notification',
-                'params': {
-                    'title': 'Estimate failed',
-                    'message': error.args[0],
-                    'type': 'danger',
-                    'sticky': False,
-                }
+                'tag': 'reload',
             }
+        return self._get_batch_notification(
+            errors, 'Quotes Drafted', 'Estimate failed', 'Quotes drafted.')
+
+    def draft_merged_quote(self) -> None:
+        return self.draft_quote(merge=True)
+
+    def _write_status(self, errors: dict, success: str, failure: str) -> None:
+        failed = self.browse(list(errors))
+        if passed := self - failed:
+            passed.write({'status': success})
+        if failed:
+            failed.write({'status': failure})
+
+    # A single record keeps the plain message, batches get a summary
+    # followed by one line per failed record
+    def _get_batch_notification(self, errors: dict, title_ok: str,
+                                title_failed: str, message_ok: str) -> dict:
+        if len(self) == 1:
+            message = errors.get(self.id) or message_ok
+        elif errors:
+            names = dict(self.browse(list(errors)).name_get())
+            message = '\n'.join(
+                [f'{len(self) - len(errors)} of {len(self)} passed.'] +
+                [f'{names[record_id]}: {error}' for record_id, error in errors.items()])
+        else:
+            message = f'{len(self)} inspections: {message_ok}'
         return {
             'type': 'ir.actions.client',
-            'tag': 'reload',
+            'tag': 'display_notification',
+            'params': {
+                'title': title_ok if not errors else title_failed,
+                'message': message,
+                'type': 'success' if not errors else 'danger',
+                'sticky': bool(errors) and len(self) > 1,
+            }
         }
 
     def _validate_observations(self) -> None:
@@ -255,107 +249,183 @@ class ElectricalInspection(models.Model):
         assert self.pipe_size, 'Pipe size not calculated'
         _logger.info('Calculation validated')
 
-    # First we calculate the cable size based on the amperage and distance
-    # Then we increase the cable size until the AC loss is less than 3%
+    # Size cable and conduit for every record in one pass of the sizing
+    # engine, then write the results back with one write per distinct
+    # (cable, pipe) pair. Returns {record id: error} for the records that
+    # could not be sized, those are left untouched.
+    def _calculate_sizing(self) -> dict:
+        by_table = {}
+        for record in self:
+            by_table.setdefault(record.ampacity_table, []).append(record)
+        groups, errors = {}, {}
+        for table, records in by_table.items():
+            results = get_engine(table).size_many([record._get_sizing_run() for record in records])
+            for record, result in zip(records, results):
+                if result.error:
+                    errors[record.id] = result.error
+                else:
+                    groups.setdefault((result.cable_size, result.pipe_size), []).append(record.id)
+        for (cable_size, pipe_size), ids in groups.items():
+            self.browse(ids).write({'cable_size': cable_size, 'pipe_size': pipe_size})
+        _logger.info(f'Sized {len(self) - len(errors)} runs, {len(errors)} failed')
+        return errors
+
+    # The cable size is increased until the AC loss is less than 3%
     # This is required by NEC 2017
     def _calculate_cable(self) -> None:
-        cable_size = self._get_base_cable_size()
-        ac_loss = self._get_ac_loss(cable_size)
-        while ac_loss > 3 and cable_size != '4/0':
-            cable_size = self._get_next_cable_size(cable_size)
-            ac_loss = self._get_ac_loss(cable_size)
-        self.cable_size = cable_size
-        _logger.info(f'Final cable size: {cable_size}')  
-        
+        for record in self:
+            result = record._get_sizing_engine().size(record._get_sizing_run())
+            if not result.cable_size:
+                raise exceptions.UserError(result.error)
+            record.cable_size = result.cable_size
+
+    def _get_sizing_engine(self):
+        return get_engine(self.ampacity_table)
+
+    def _get_sizing_run(self) -> SizingRun:
+        return SizingRun(
+            amperage=int(self.amperage),
+            distance=self.distance,
+            material=self.cable_material,
+            temperature=self.temperature_rating,
+            voltage=int(self.supply_voltage),
+            num_cables=self.num_cables,
+        )
+
     def _get_base_cable_size(self) -> str:
-        amperage = int(self.amperage)
-        temp_rating = self.temperature_rating
-        for cable_size, temp_to_amps in AWG_TEMP_AMPACITY.items():
-            if temp_to_amps[f'C{temp_rating}'] >= amperage:
-                _logger.info(f'Base cable size: {cable_size}')
-                return cable_size
-        raise exceptions.UserError('No cable size defined for amperage and temperature')
+        engine = self._get_sizing_engine()
+        index = engine.base_index(int(self.amperage), self.cable_material, self.temperature_rating)
+        if index is None:
+            raise exceptions.UserError('No cable size defined for amperage, material and temperature')
+        return engine.gauges[index]
 
     # Calculate the AC loss for the cable based on the amperage and distance
     def _get_ac_loss(self, base_cable_size: str) -> float:
-        resistivity = RESISTIVITY[self.cable_material]
-        conduit_area = self._get_awg_area(base_cable_size)
-        resistance = resistivity * self.distance / conduit_area
-        voltage_drop = self.amperage * resistance
-        power_loss = self.amperage * voltage_drop
-        total_power = int(self.supply_voltage) * self.amperage
-        ac_loss_percentage = 100 * power_loss / total_power
-        _logger.info(f'AC loss: {ac_loss_percentage}')
-        return ac_loss_percentage
+        return self._get_sizing_engine().ac_loss(
+            base_cable_size, self.amperage, self.distance,
+            self.cable_material, int(self.supply_voltage), self.num_cables)
 
     # Calculate the circular area for an AWG cable based on its diameter
     def _get_awg_area(self, diameter: str) -> float:
-        d = AWG_DIAMETER_INCHES.get(diameter)
-        if d is None:
-            raise ValueError(f"Invalid AWG size: {diameter}")
-        # Calculate the area using the formula for area of a circle
-        return math.pi * (d / 2)**2
-
-    def _get_next_cable_size(self, base_cable_size: str) -> str:
-        index = list(AWG_TEMP_AMPACITY.keys()).index(base_cable_size)
-        next_cable_size = list(AWG_TEMP_AMPACITY.keys())[index + 1]
-        return next_cable_size
-
-    def _draft_sales_order(self) -> None:
-        order = self.env['sale.order'].create({
-            'partner_id': self.customer_id.id,
-            'partner_invoice_id': self.customer_id.id,
-            'user_id': self.engineer_id.id,
-            'date_order': self.date,
+        return self._get_sizing_engine().area(diameter)
+
+    # Build the quotes of the whole recordset: products are resolved once
+    # per batch, then every order and its lines are created with a single
+    # create call. If that create fails, each order is created on its own
+    # so the failure only lands on its inspections. Returns {record id:
+    # error} for the records left out.
+    def _draft_sales_orders(self, merge=False) -> dict:
+        errors, items = {}, {}
+        for record in self:
+            if not record.customer_id:
+                errors[record.id] = 'Customer not defined'
+                continue
+            try:
+                items[record.id] = record._get_quote_items()
+            except Exception as error:
+                errors[record.id] = error.args[0] if error.args else str(error)
+        products = self._get_quote_products(
+            [item for record_items in items.values() for item in record_items])
+
+        lines = {}
+        for record_id, record_items in items.items():
+            try:
+                lines[record_id] = [
+                    self._get_quote_line_vals(products, item) for item in record_items]
+            except exceptions.UserError as error:
+                errors[record_id] = error.args[0]
+
+        # One order per record, or per customer when merging
+        groups = {}
+        for record in self.filtered(lambda r: r.id in lines):
+            key = record.customer_id.id if merge else record.id
+            groups.setdefault(key, self.browse())
+            groups[key] |= record
+        groups = list(groups.values())
+        SaleOrder = self.env['sale.order']
+        try:
+            with self.env.cr.savepoint():
+                orders = SaleOrder.create([records._get_sales_order_vals(lines) for records in groups])
+                for records, order in zip(groups, orders):
+                    records.write({'sales_order_id': order.id})
+        except Exception:
+            _logger.info('Batch quote failed, drafting one quote at a time')
+            orders = SaleOrder
+            for records in groups:
+                try:
+                    # A failed quote must not leave a half built order behind
+                    with self.env.cr.savepoint():
+                        order = SaleOrder.create(records._get_sales_order_vals(lines))
+                        records.write({'sales_order_id': order.id})
+                    orders |= order
+                except Exception as error:
+                    for record in records:
+                        errors[record.id] = error.args[0] if error.args else str(error)
+        _logger.info(f'Drafted {len(orders)} quotes for {len(self) - len(errors)} inspections')
+        return errors
+
+    def _get_sales_order_vals(self, lines: dict) -> dict:
+        engineers = self.mapped('engineer_id')
+        return {
+            'partner_id': self[0].customer_id.id,
+            'partner_invoice_id': self[0].customer_id.id,
+            'user_id': engineers.id if len(engineers) == 1 else self.env.user.id,
+            'date_order': min(filter(None, self.mapped('date')), default=False) or fields.Date.today(),
             'state': 'draft',
-        })
-        self.sales_order_id = order.id
-        self._add_cable_to_order(order, color='black')
-
-    def _add_cable_to_order(self, order: models.Model, color='black') -> None:
-        units = self._get_cable_units()
-        if not (cable := self.env['product.product'].search([
-            ('name', '=', 'Cable'),
-            ('type', '=', 'product'),
-            ('material', '=', self.cable_material),
-            ('color', '=', color),
-        ], limit=1)):
-            raise exceptions.UserError('Cable not found in product list')
-        else:
-            _logger.info(f'Adding {units} units of {cable.name} to order')
-            self.env['sale.order.line'].create({
-                'order_id': order.id,
-                'product_id': cable.id,
-                'product_uom_qty': units,
-                'product_uom': cable.uom_id.id,
-                'price_unit': cable.list_price,
-            })
-            _logger.info(f'Added {units} units of {cable.name} to order')
+            'order_line': [
+                (0, 0, vals) for record in self for vals in lines[record.id]],
+        }
+
+    # Products to quote for the inspection. Each item names the product by
+    # name, material and color, new kinds of items (conduit, breaker,
+    # labor) only need to be added here.
+    def _get_quote_items(self) -> list:
+        return [{
+            'name': 'Cable',
+            'material': self.cable_material,
+            'color': 'black',
+            'quantity': self._get_cable_units(),
+        }]
+
+    # {(name, material, color): product} with one search per product name,
+    # whatever the number of inspections in the batch
+    def _get_quote_products(self, items: list) -> dict:
+        wanted = {}
+        for item in items:
+            wanted.setdefault(item['name'], set()).add((item['material'], item['color']))
+        products = {}
+        Product = self.env['product.product']
+        for name, keys in wanted.items():
+            for product in Product.search([
+                ('name', '=', name),
+                ('type', '=', 'product'),
+                ('material', 'in', list({material for material, _color in keys})),
+                ('color', 'in', list({color for _material, color in keys})),
+            ]):
+                products.setdefault((name, product.material, product.color), product)
+        return products
+
+    def _get_quote_line_vals(self, products: dict, item: dict) -> dict:
+        if not (product := products.get((item['name'], item['material'], item['color']))):
+            raise exceptions.UserError(f'{item["name"]} not found in product list')
+        return {
+            'product_id': product.id,
+            'product_uom_qty': item['quantity'],
+            'product_uom': product.uom_id.id,
+            'price_unit': product.list_price,
+        }
 
     def _get_cable_units(self) -> int:
         return math.ceil(self.distance / 3) * self.num_chargers * self.num_cables
 
+    # The NEC specifications are: One wire: maximum fill is 53% of the space inside a conduit.
+    # Two wires: maximum fill is 31%
+    # Three wires or more: maximum fill is 40% of the conduit's total available space.
     def _calculate_pipe(self) -> None:
-        # First use the AWG diameter to calculate the area of the cable
-        # The NEC specifications are: One wire: maximum fill is 53% of the space inside a conduit. 
-        # Two wires: maximum fill is 31% 
-        # Three wires or more: maximum fill is 40% of the conduit's total available space.
-        cable_area = self._get_awg_area(self.cable_size)
-        if self.num_cables == 1:
-            max_fill = 0.53
-        elif self.num_cables == 2:
-            max_fill = 0.31
-        else:
-            max_fill = 0.4
-        required_pipe_area = cable_area * self.num_cables / max_fill
-        required_pipe_diameter = math.sqrt(required_pipe_area / math.pi) * 2
-        self.pipe_size = self._get_smallest_suitable_conduit(required_pipe_diameter)
-        _logger.info(f'Final pipe size: {self.pipe_size}')
-
-    def _get_smallest_suitable_conduit(self, required_pipe_diameter: float) -> str:
-        # Use the pipe sizes, picking the smallest one that is larger than the required diameter
-        # From CONDUIT_SIZES_INCHES
-        for pipe_size, pipe_diameter in CONDUIT_SIZES_INCHES.items():
-            if pipe_diameter >= required_pipe_diameter:
-                return pipe_size
-        raise exceptions.UserError('No suitable pipe size found')
+        for record in self:
+            record.pipe_size = record._get_smallest_suitable_conduit()
+
+    def _get_smallest_suitable_conduit(self) -> str:
+        if not (pipe_size := self._get_sizing_engine().conduit_for(self.cable_size, self.num_cables)):
+            raise exceptions.UserError('No suitable pipe size found')
+        return pipe_size
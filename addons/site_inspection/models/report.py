@@ -0,0 +1,167 @@
+import logging
+from odoo import models, fields, api
+
+_logger = logging.getLogger(__name__)
+
+
+# Reporting models for the planner dashboards. Both are backed by
+# PostgreSQL materialized views, so pivots and graphs read precomputed
+# rows instead of grouping inspections and computing cable units per row.
+# A cron refreshes them concurrently, readers are never blocked.
+
+# Same formula as ElectricalInspection._get_cable_units, in SQL
+CABLE_UNITS_SQL = """
+    CEIL(COALESCE(i.distance, 0) / 3.0)::integer
+    * COALESCE(i.num_chargers, 0) * COALESCE(i.num_cables, 0)
+"""
+
+
+class MaterializedReportMixin(models.AbstractModel):
+    _name = 'inspection.report.mixin'
+    _description = 'Materialized Report'
+
+    # SELECT of the view, must return a unique id column
+    def _get_query(self) -> str:
+        raise NotImplementedError()
+
+    def init(self):
+        if self._abstract:
+            return
+        self.env.cr.execute('SELECT relkind FROM pg_class WHERE relname = %s', (self._table,))
+        row = self.env.cr.fetchone()
+        if row and row[0] == 'm':
+            self.env.cr.execute(f'DROP MATERIALIZED VIEW {self._table} CASCADE')
+        elif row and row[0] == 'v':
+            self.env.cr.execute(f'DROP VIEW {self._table} CASCADE')
+        self.env.cr.execute(f'CREATE MATERIALIZED VIEW {self._table} AS ({self._get_query()})')
+        # REFRESH ... CONCURRENTLY needs a unique index over all rows
+        self.env.cr.execute(f'CREATE UNIQUE INDEX {self._table}_id_uniq ON {self._table} (id)')
+
+    def _refresh(self) -> None:
+        self.flush()
+        self.env.cr.execute(f'REFRESH MATERIALIZED VIEW CONCURRENTLY {self._table}')
+        self.invalidate_cache()
+
+    @api.model
+    def _cron_refresh(self) -> None:
+        for model in REPORT_MODELS:
+            self.env[model]._refresh()
+            _logger.info(f'Refreshed {model}')
+
+
+# One row per electrical inspection, with the cable units precomputed
+
+class ElectricalInspectionReport(models.Model):
+    _name = 'electrical.inspection.report'
+    _inherit = 'inspection.report.mixin'
+    _description = 'Electrical Inspection Analysis'
+    _auto = False
+    _rec_name = 'date'
+    _order = 'date desc'
+
+    inspection_id = fields.Many2one('electrical.inspection.record', string='Inspection', readonly=True)
+    status = fields.Selection([
+        ('pending', 'Pending'),
+        ('validated', 'Validated'),
+        ('calculated', 'Calculated'),
+        ('failure', 'Failed'),
+        ('drafted', 'Quote Drafted'),
+        ('archived', 'Archived'),
+        ('cancelled', 'Cancelled'),
+    ], string='Status', readonly=True)
+    purpose = fields.Selection([
+        ('pre', 'Pre-Installation'),
+        ('post', 'Post-Installation'),
+        ('maintenance', 'Maintenance'),
+        ('warranty', 'Warranty'),
+        ('other', 'Other'),
+    ], string='Purpose', readonly=True)
+    engineer_id = fields.Many2one('res.users', string='Engineer', readonly=True)
+    customer_id = fields.Many2one('res.partner', string='Customer', readonly=True)
+    date = fields.Date(string='Inspection Date', readonly=True)
+    cable_material = fields.Selection([
+        ('C', 'Copper'),
+        ('A', 'Aluminum'),
+    ], string='Cable Material', readonly=True)
+    cable_size = fields.Char(string='Cable Size', readonly=True)
+    supply_voltage = fields.Char(string='Supply Voltage', readonly=True)
+    num_chargers = fields.Integer(string='Chargers', readonly=True)
+    distance = fields.Integer(string='Distance', readonly=True)
+    cable_units = fields.Integer(string='Cable Units', readonly=True)
+    has_quote = fields.Boolean(string='Quoted', readonly=True)
+
+    def _get_query(self) -> str:
+        return f"""
+            SELECT i.id AS id,
+                   i.id AS inspection_id,
+                   i.status,
+                   i.purpose,
+                   i.engineer_id,
+                   i.customer_id,
+                   i.date,
+                   i.cable_material,
+                   i.cable_size,
+                   i.supply_voltage,
+                   i.num_chargers,
+                   i.distance,
+                   {CABLE_UNITS_SQL} AS cable_units,
+                   i.sales_order_id IS NOT NULL AS has_quote
+              FROM electrical_inspection_record i
+        """
+
+
+# Inspections grouped by month, engineer, status and cable material, for
+# dashboards over the whole history
+
+class ElectricalInspectionMonthlyReport(models.Model):
+    _name = 'electrical.inspection.report.monthly'
+    _inherit = 'inspection.report.mixin'
+    _description = 'Electrical Inspection Monthly Analysis'
+    _auto = False
+    _rec_name = 'month'
+    _order = 'month desc'
+
+    month = fields.Date(string='Month', readonly=True)
+    engineer_id = fields.Many2one('res.users', string='Engineer', readonly=True)
+    status = fields.Selection([
+        ('pending', 'Pending'),
+        ('validated', 'Validated'),
+        ('calculated', 'Calculated'),
+        ('failure', 'Failed'),
+        ('drafted', 'Quote Drafted'),
+        ('archived', 'Archived'),
+        ('cancelled', 'Cancelled'),
+    ], string='Status', readonly=True)
+    cable_material = fields.Selection([
+        ('C', 'Copper'),
+        ('A', 'Aluminum'),
+    ], string='Cable Material', readonly=True)
+    inspection_count = fields.Integer(string='Inspections', readonly=True)
+    num_chargers = fields.Integer(string='Chargers', readonly=True)
+    cable_units = fields.Integer(string='Cable Units', readonly=True)
+    quote_count = fields.Integer(string='Quoted', readonly=True)
+
+    def _get_query(self) -> str:
+        return f"""
+            SELECT ROW_NUMBER() OVER (
+                       ORDER BY month, engineer_id NULLS FIRST,
+                                status NULLS FIRST, cable_material NULLS FIRST
+                   ) AS id,
+                   g.*
+              FROM (
+                SELECT DATE_TRUNC('month', i.date)::date AS month,
+                       i.engineer_id,
+                       i.status,
+                       i.cable_material,
+                       COUNT(*) AS inspection_count,
+                       SUM(COALESCE(i.num_chargers, 0)) AS num_chargers,
+                       SUM({CABLE_UNITS_SQL}) AS cable_units,
+                       COUNT(i.sales_order_id) AS quote_count
+                  FROM electrical_inspection_record i
+                 GROUP BY 1, 2, 3, 4
+              ) g
+        """
+
+
+# Refreshed by the cron, in this order
+REPORT_MODELS = ('electrical.inspection.report', 'electrical.inspection.report.monthly')
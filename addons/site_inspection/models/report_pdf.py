@@ -0,0 +1,160 @@
+import hashlib
+import logging
+from odoo import models, exceptions
+from odoo.addons.base.models.ir_actions_report import _get_wkhtmltopdf_bin
+from odoo.tools.pdf import merge_pdf
+
+from ..tools.pdf import render_many
+
+_logger = logging.getLogger(__name__)
+
+
+# Bump when the report output changes in a way the template views do not show
+REPORT_VERSION = '1'
+
+# Report action of each inspection model
+REPORTS = {
+    'inspection.record': 'site_inspection.action_report_inspection',
+    'electrical.inspection.record': 'site_inspection.action_report_electrical_inspection',
+}
+
+# Cached PDFs are attachments named with this prefix and their cache key
+ATTACHMENT_PREFIX = 'inspection-report-'
+
+
+# Inspection reports are rendered by a bounded pool of wkhtmltopdf processes
+# and kept as attachments keyed by the write_date of the record and of what
+# it prints, and by the template version, so printing again after no change
+# reuses the stored PDF.
+
+class InspectionReportPdf(models.Model):
+
+    _inherit = 'inspection.record'
+
+    # Render the reports of every selected inspection ahead of time
+    def render_reports(self) -> None:
+        errors = self._cache_report_pdfs()[1]
+        return self._get_batch_notification(
+            errors, 'Reports Rendered', 'Render Failed', 'Reports ready to print.')
+
+    # {record id: ir.attachment} with the current PDF of every record
+    def _get_report_pdfs(self) -> dict:
+        cached, errors = self._cache_report_pdfs()
+        if errors:
+            names = dict(self.browse(list(errors)).name_get())
+            raise exceptions.UserError('\n'.join(
+                f'{names[record_id]}: {error}' for record_id, error in errors.items()))
+        return cached
+
+    # Render only the records whose cached PDF is missing or stale.
+    # Returns ({record id: ir.attachment}, {record id: error}).
+    def _cache_report_pdfs(self):
+        report = self.env.ref(REPORTS[self._name]).sudo()
+        version = self._get_report_version(report)
+        keys = {record.id: record._get_report_cache_key(version) for record in self}
+        Attachment = self.env['ir.attachment'].sudo()
+        cached = {
+            attachment.res_id: attachment
+            for attachment in Attachment.search([
+                ('res_model', '=', self._name),
+                ('res_id', 'in', self.ids),
+                ('name', 'in', [f'{ATTACHMENT_PREFIX}{key}.pdf' for key in keys.values()]),
+            ])
+        }
+        missing = self.filtered(lambda r: r.id not in cached)
+        if not missing:
+            return cached, {}
+
+        pdfs, errors = missing._render_report_pdfs(report)
+        # One PDF per record, older versions go away
+        Attachment.search([
+            ('res_model', '=', self._name),
+            ('res_id', 'in', list(pdfs)),
+            ('name', '=like', f'{ATTACHMENT_PREFIX}%'),
+        ]).unlink()
+        created = Attachment.create([{
+            'name': f'{ATTACHMENT_PREFIX}{keys[record_id]}.pdf',
+            'type': 'binary',
+            'raw': pdf,
+            'mimetype': 'application/pdf',
+            'res_model': self._name,
+            'res_id': record_id,
+        } for record_id, pdf in pdfs.items()])
+        cached.update(zip(pdfs, created))
+        _logger.info(f'Rendered {len(pdfs)} inspection reports, '
+                     f'{len(cached) - len(pdfs)} cached, {len(errors)} failed')
+        return cached, errors
+
+    def _get_report_cache_key(self, version: str) -> str:
+        parts = ':'.join(str(part) for part in self._get_report_cache_parts())
+        key = f'{self._name}:{self.id}:{parts}:{version}'
+        return hashlib.sha256(key.encode('utf-8')).hexdigest()[:32]
+
+    # Last changes to everything the report prints, the customer and the
+    # engineer are printed by name and can be renamed on their own
+    def _get_report_cache_parts(self) -> list:
+        return [
+            self.write_date,
+            self.customer_id.write_date,
+            self.engineer_id.partner_id.write_date,
+        ]
+
+    # REPORT_VERSION plus the last change to the report templates, editing
+    # a template in the database also invalidates the cache
+    def _get_report_version(self, report) -> str:
+        views = self.env['ir.ui.view'].sudo().search([
+            ('key', '=like', f'{report.report_name.split(".")[0]}.report_%'),
+        ])
+        changed = max(views.mapped('write_date'), default='')
+        return f'{REPORT_VERSION}:{changed}'
+
+    # The HTML of every record is rendered here in one QWeb call, only
+    # wkhtmltopdf runs in the pool. Returns ({id: pdf}, {id: error}).
+    def _render_report_pdfs(self, report):
+        Report = self.env['ir.actions.report'].sudo()
+        html = Report._render_qweb_html(report.report_name, self.ids)[0]
+        bodies, html_ids, header, footer, specific_args = Report._prepare_html(
+            html, report_model=report.model)
+        args = Report._build_wkhtmltopdf_args(
+            report.get_paperformat().id,
+            self.env.context.get('landscape'),
+            specific_paperformat_args=specific_args,
+            set_viewport_size=self.env.context.get('set_viewport_size'),
+        )
+        jobs = dict(zip(html_ids, bodies)) if len(html_ids) == len(bodies) else {}
+        if set(jobs) != set(self.ids):
+            raise exceptions.UserError('Could not split the report per inspection')
+        results = render_many(_get_wkhtmltopdf_bin(), args, jobs, header, footer)
+        pdfs = {record_id: pdf for record_id, (pdf, error) in results.items() if not error}
+        errors = {record_id: error for record_id, (pdf, error) in results.items() if error}
+        return pdfs, errors
+
+
+class ElectricalInspectionReportPdf(models.Model):
+
+    _inherit = 'electrical.inspection.record'
+
+    # Segments can be edited and sized without writing the inspection
+    def _get_report_cache_parts(self) -> list:
+        return super(ElectricalInspectionReportPdf, self)._get_report_cache_parts() + [
+            len(self.segment_ids),
+            max(self.segment_ids.mapped('write_date'), default=''),
+        ]
+
+
+class IrActionsReport(models.Model):
+
+    _inherit = 'ir.actions.report'
+
+    # Printing inspection reports goes through the cache and the pool.
+    # /report/download passes the user context as data, that alone does
+    # not change the report.
+    def _render_qweb_pdf(self, report_ref, res_ids=None, data=None):
+        report = self._get_report(report_ref)
+        extra_data = {key: value for key, value in (data or {}).items() if key != 'context'}
+        if report.model in REPORTS and res_ids and not extra_data:
+            res_ids = [res_ids] if isinstance(res_ids, int) else list(res_ids)
+            pdfs = self.env[report.model].browse(res_ids)._get_report_pdfs()
+            streams = [pdfs[res_id].raw for res_id in res_ids]
+            return (streams[0] if len(streams) == 1 else merge_pdf(streams)), 'pdf'
+        return super(IrActionsReport, self)._render_qweb_pdf(report_ref, res_ids=res_ids, data=data)
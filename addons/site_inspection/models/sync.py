@@ -0,0 +1,355 @@
+import uuid
+import logging
+from datetime import timedelta
+from odoo import models, fields, api
+
+_logger = logging.getLogger(__name__)
+
+
+# Fields exchanged with the offline field capture client. The client may
+# write CLIENT_FIELDS, it receives changes to all of SYNC_FIELDS.
+CLIENT_FIELDS = (
+    'customer_id', 'purpose', 'date', 'location',
+    'amperage', 'distance', 'num_chargers', 'num_cables', 'turns',
+    'cable_material', 'supply_voltage', 'temperature_rating', 'pipe_material',
+    'req_burrowing', 'req_wall_drilling', 'inspector_notes', 'customer_notes',
+)
+SYNC_FIELDS = CLIENT_FIELDS + ('name', 'status', 'cable_size', 'pipe_size', 'sales_order_id')
+
+# Largest number of drafts accepted in one sync request
+MAX_BATCH = 500
+
+# Days change log rows are kept, clients syncing less often get everything
+LOG_RETENTION_DAYS = 30
+
+
+# Change log behind the sync tokens. Every create, write and unlink of an
+# inspection adds a row naming the synced fields it touched. Rows carry the
+# id of the transaction that wrote them (txid column, added in init), and
+# a token is the oldest transaction still running when it was issued:
+# every row below it is committed and was seen, rows at or above it are
+# sent again, so a transaction committing late is never skipped.
+
+class InspectionSyncLog(models.Model):
+
+    _name = 'electrical.inspection.sync.log'
+    _description = 'Electrical Inspection Sync Log'
+    _order = 'id'
+
+    inspection_id = fields.Integer(string='Inspection', required=True, index=True)
+    engineer_id = fields.Many2one('res.users', string='Engineer', index=True)
+    changed = fields.Char(string='Changed Fields')
+    deleted = fields.Boolean(string='Deleted')
+
+    def init(self):
+        self.env.cr.execute(f"""
+            ALTER TABLE {self._table}
+              ADD COLUMN IF NOT EXISTS txid bigint NOT NULL DEFAULT txid_current()
+        """)
+        self.env.cr.execute(f"""
+            CREATE INDEX IF NOT EXISTS {self._table}_engineer_txid_idx
+                ON {self._table} (engineer_id, txid)
+        """)
+
+    # Token for the changes visible now, see the class comment
+    @api.model
+    def _get_token(self) -> int:
+        self.flush()
+        self.env.cr.execute('SELECT txid_snapshot_xmin(txid_current_snapshot())')
+        return self.env.cr.fetchone()[0]
+
+    # Tokens at or below this may have missed rows removed by the autovacuum
+    @api.model
+    def _get_purged_token(self) -> int:
+        return int(self.env['ir.config_parameter'].sudo().get_param(
+            'site_inspection.sync_log_purged', 0))
+
+    @api.autovacuum
+    def _gc_sync_log(self):
+        self.flush()
+        self.env.cr.execute(f"""
+            DELETE FROM {self._table} WHERE create_date < %s RETURNING txid
+        """, (fields.Datetime.now() - timedelta(days=LOG_RETENTION_DAYS),))
+        if purged := max((txid for txid, in self.env.cr.fetchall()), default=0):
+            self.env['ir.config_parameter'].sudo().set_param(
+                'site_inspection.sync_log_purged', max(purged, self._get_purged_token()))
+        self.invalidate_cache()
+
+
+class ElectricalInspectionSync(models.Model):
+
+    _inherit = 'electrical.inspection.record'
+
+    client_uuid = fields.Char(
+        string='Client UUID', readonly=True, copy=False, index=True,
+        help='Identifier generated by the field capture client, makes uploads idempotent')
+
+    _sql_constraints = [
+        ('client_uuid_uniq', 'unique(client_uuid)', 'This inspection was already uploaded.'),
+    ]
+
+    @api.model_create_multi
+    def create(self, vals_list):
+        records = super(ElectricalInspectionSync, self).create(vals_list)
+        records._log_sync_change(SYNC_FIELDS)
+        return records
+
+    def write(self, vals):
+        result = super(ElectricalInspectionSync, self).write(vals)
+        if changed := [name for name in SYNC_FIELDS if name in vals]:
+            # name is computed from the customer and the date
+            if 'name' not in changed and {'customer_id', 'date'} & set(vals):
+                changed.append('name')
+            self._log_sync_change(changed)
+        return result
+
+    def unlink(self):
+        self.env['electrical.inspection.sync.log'].sudo().create([{
+            'inspection_id': record.id,
+            'engineer_id': record.engineer_id.id,
+            'deleted': True,
+        } for record in self])
+        return super(ElectricalInspectionSync, self).unlink()
+
+    def _log_sync_change(self, changed) -> None:
+        if self:
+            self.env['electrical.inspection.sync.log'].sudo().create([{
+                'inspection_id': record.id,
+                'engineer_id': record.engineer_id.id,
+                'changed': ','.join(changed),
+            } for record in self])
+
+    # Upsert a batch of drafts from the field capture client and return
+    # what changed on the server since its token, in one transaction.
+    # Each draft is {'uuid': ..., 'fields': {...}}, the answer is
+    # {'token', 'reset', 'results': [{uuid, id, status, error, fields}],
+    #  'changes': [{uuid, id, fields}], 'deleted': [ids]}. Results of
+    # created and updated drafts carry every synced field as stored on the
+    # server (name, status, defaults), so the client need not wait for the
+    # next sync to see them.
+    @api.model
+    def _sync_from_client(self, drafts: list, token: int = 0) -> dict:
+        if not isinstance(drafts, list):
+            return {'error': 'Inspections must be a list'}
+        if len(drafts) > MAX_BATCH:
+            return {'error': f'At most {MAX_BATCH} inspections per sync'}
+        Log = self.env['electrical.inspection.sync.log']
+        reset = not token or token <= Log._get_purged_token()
+        # Read before the upload, the upload's own rows are already in results
+        changes, deleted = self._get_sync_changes(None if reset else token)
+        results = self._sync_upsert(drafts)
+        return {
+            'token': Log._get_token(),
+            'reset': reset,
+            'results': results,
+            'changes': changes,
+            'deleted': deleted,
+        }
+
+    # Each draft is checked on its own, then drafts are created and written
+    # in bulk inside a savepoint, falling back to one savepoint per draft
+    # when the bulk call fails, so one bad draft only fails itself.
+    def _sync_upsert(self, drafts: list) -> list:
+        results, valid = [], {}
+        for draft in drafts:
+            if not isinstance(draft, dict):
+                results.append({'uuid': None, 'status': 'error', 'error': 'Draft must be an object'})
+                continue
+            client_uuid = str(draft.get('uuid') or '')
+            try:
+                uuid.UUID(client_uuid)
+            except ValueError:
+                results.append({'uuid': client_uuid, 'status': 'error', 'error': 'Invalid uuid'})
+                continue
+            values = draft.get('fields') or {}
+            if not isinstance(values, dict):
+                results.append({'uuid': client_uuid, 'status': 'error', 'error': 'Fields must be an object'})
+                continue
+            # Last draft wins if a uuid is sent twice
+            valid[client_uuid] = values
+        existing = {
+            record.client_uuid: record
+            for record in self.search([('client_uuid', 'in', list(valid))])
+        } if valid else {}
+        partners = self._get_sync_partners(valid.values())
+
+        to_create, to_write = {}, {}
+        for client_uuid, values in valid.items():
+            vals, error = self._get_sync_vals(values, partners)
+            if not error and client_uuid in existing:
+                error = existing[client_uuid]._check_sync_editable()
+            if error:
+                results.append({'uuid': client_uuid, 'status': 'error', 'error': error})
+            elif client_uuid in existing:
+                to_write[client_uuid] = vals
+            else:
+                to_create[client_uuid] = dict(vals, client_uuid=client_uuid)
+
+        def create(batch):
+            return dict(zip(batch, self.create(list(batch.values()))))
+
+        def write(batch):
+            # Drafts with identical values share a single write
+            groups = {}
+            for client_uuid, vals in batch.items():
+                groups.setdefault(tuple(sorted(vals.items())), self.browse())
+                groups[tuple(sorted(vals.items()))] |= existing[client_uuid]
+            for vals, records in groups.items():
+                if vals:
+                    records.write(dict(vals))
+            return {client_uuid: existing[client_uuid] for client_uuid in batch}
+
+        created, create_errors = self._sync_apply(to_create, create)
+        written, write_errors = self._sync_apply(to_write, write)
+        payload = {
+            row['uuid']: row
+            for row in self._get_sync_payload(
+                self.browse([record.id for record in list(created.values()) + list(written.values())]),
+                SYNC_FIELDS)
+        }
+        for status, done in (('created', created), ('updated', written)):
+            for client_uuid, record in done.items():
+                results.append({
+                    'uuid': client_uuid,
+                    'id': record.id,
+                    'status': status,
+                    'fields': payload[client_uuid]['fields'],
+                })
+        for client_uuid, error in dict(create_errors, **write_errors).items():
+            results.append({'uuid': client_uuid, 'status': 'error', 'error': error})
+        _logger.info(f'Sync upload: {len(created)} created, {len(written)} updated, '
+                     f'{len(drafts) - len(created) - len(written)} rejected')
+        return results
+
+    # Run apply over the whole batch in a savepoint, or draft by draft if
+    # that fails. Returns ({uuid: record}, {uuid: error}).
+    def _sync_apply(self, batch: dict, apply):
+        if not batch:
+            return {}, {}
+        try:
+            with self.env.cr.savepoint():
+                done = apply(batch)
+            return done, {}
+        except Exception:
+            _logger.info('Sync batch failed, applying drafts one at a time')
+        done, errors = {}, {}
+        for client_uuid, vals in batch.items():
+            try:
+                with self.env.cr.savepoint():
+                    result = apply({client_uuid: vals})
+                done.update(result)
+            except Exception as error:
+                errors[client_uuid] = error.args[0] if error.args else type(error).__name__
+        return done, errors
+
+    # Clients only edit their own inspections, and only while pending:
+    # later statuses were checked, sized or quoted from the current values
+    def _check_sync_editable(self):
+        if self.engineer_id.id != self.env.uid:
+            return 'Inspection belongs to another engineer'
+        if self.status != 'pending':
+            return f'Inspection is {self.status} and can no longer be edited'
+        return None
+
+    # Customers referenced by the drafts that exist, one query for all
+    def _get_sync_partners(self, values_list) -> set:
+        ids = {values.get('customer_id') for values in values_list} - {None, False}
+        ids = {partner_id for partner_id in ids if isinstance(partner_id, int)}
+        return set(self.env['res.partner'].browse(ids).exists().ids) if ids else set()
+
+    # Values for create/write from the client fields, or an error
+    def _get_sync_vals(self, values: dict, partners: set):
+        vals = {}
+        for name, value in values.items():
+            if name not in CLIENT_FIELDS:
+                return None, f'Field {name} cannot be synced'
+            field = self._fields[name]
+            if value is None or value is False:
+                vals[name] = False
+            elif field.type == 'many2one':
+                if value not in partners:
+                    return None, f'Unknown customer {value}'
+                vals[name] = value
+            elif field.type == 'selection':
+                if value not in field.get_values(self.env):
+                    return None, f'Invalid value {value} for {name}'
+                vals[name] = value
+            elif field.type == 'integer':
+                if not isinstance(value, int) or isinstance(value, bool):
+                    return None, f'{name} must be an integer'
+                vals[name] = value
+            elif field.type == 'boolean':
+                vals[name] = bool(value)
+            elif field.type == 'date':
+                try:
+                    vals[name] = fields.Date.to_date(value)
+                except (TypeError, ValueError):
+                    return None, f'{name} must be a date'
+            else:
+                vals[name] = str(value)
+        return vals, None
+
+    # Synced fields changed since token (everything when token is None) on
+    # the current user's inspections, only the fields that changed
+    def _get_sync_changes(self, token):
+        if token is None:
+            records = self.search([('engineer_id', '=', self.env.uid)])
+            changed = {record.id: set(SYNC_FIELDS) for record in records}
+            deleted = []
+        else:
+            changed, deleted = {}, []
+            Log = self.env['electrical.inspection.sync.log']
+            Log.flush()
+            self.env.cr.execute(f"""
+                SELECT inspection_id, changed, deleted
+                  FROM {Log._table}
+                 WHERE engineer_id = %s AND txid >= %s
+                 ORDER BY id
+            """, (self.env.uid, token))
+            for inspection_id, names, is_deleted in self.env.cr.fetchall():
+                if is_deleted:
+                    changed.pop(inspection_id, None)
+                    deleted.append(inspection_id)
+                elif names:
+                    changed.setdefault(inspection_id, set()).update(names.split(','))
+        records = self.browse(list(changed)).exists()
+        # One read per distinct set of changed fields
+        groups = {}
+        for record in records:
+            groups.setdefault(frozenset(changed[record.id]), self.browse())
+            groups[frozenset(changed[record.id])] |= record
+        changes = []
+        for names, group in groups.items():
+            changes += self._get_sync_payload(group, sorted(names))
+        return changes, deleted
+
+    def _get_sync_payload(self, records, names) -> list:
+        payload = []
+        for row in records.read(['client_uuid'] + list(names)):
+            record_id = row.pop('id')
+            client_uuid = row.pop('client_uuid')
+            payload.append({
+                'id': record_id,
+                'uuid': client_uuid or None,
+                'fields': {
+                    name: value[0] if isinstance(value, tuple) else value
+                    for name, value in row.items()
+                },
+            })
+        return payload
+
+
+# The inspection name is computed from the customer name, a rename
+# changes it without a write on the inspections
+
+class ResPartnerSync(models.Model):
+
+    _inherit = 'res.partner'
+
+    def write(self, vals):
+        result = super(ResPartnerSync, self).write(vals)
+        if 'name' in vals:
+            self.env['electrical.inspection.record'].sudo().search([
+                ('customer_id', 'in', self.ids),
+            ])._log_sync_change(['name'])
+        return result
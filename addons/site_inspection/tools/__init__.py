@@ -0,0 +1,2 @@
+# Plain Python helpers used by the inspection models.
+# Nothing in this package touches the ORM, so it is safe to call from threads.
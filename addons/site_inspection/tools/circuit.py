@@ -0,0 +1,146 @@
+import math
+from collections import Counter, namedtuple
+
+from .sizing import MAX_AC_LOSS
+
+
+# Resolution of the drop budget in percent. Drops are rounded up to it, so
+# a solution found is always within the limit.
+DROP_STEP = 0.01
+
+INFINITY = float('inf')
+
+
+class Segment:
+    # One cable run of a circuit: a feeder, a panel tap or a charger run.
+    # load is the current drawn at the end of this segment itself (the
+    # chargers it feeds), children draw their own on top of it.
+
+    __slots__ = ('key', 'length', 'load', 'children', 'current', 'signature')
+
+    def __init__(self, key, length, load=0.0, children=()):
+        self.key = key
+        self.length = length
+        self.load = load
+        self.children = list(children)
+        self.current = None
+        self.signature = None
+
+
+SegmentResult = namedtuple('SegmentResult', ['gauge', 'current', 'drop', 'cumulative_drop'])
+CircuitResult = namedtuple('CircuitResult', ['segments', 'cost', 'error'])
+
+
+class CircuitSolver:
+    # Picks a gauge for every segment of a radial circuit so that the
+    # cumulative voltage drop from the supply to every charger stays within
+    # max_drop, at the lowest conductor cost.
+    #
+    # The cheapest subtree for a given remaining drop budget only depends on
+    # the subtree's shape (lengths, currents and the same for its children),
+    # not on where it hangs. Subtrees are reduced to a signature, and results
+    # are memoized per (signature, budget). A garage with two hundred
+    # identical charger runs therefore solves one charger subproblem per
+    # budget, not two hundred.
+
+    def __init__(self, engine, material, temperature, voltage, num_cables=1,
+                 max_drop=MAX_AC_LOSS, gauge_cost=None, step=DROP_STEP):
+        self.engine = engine
+        self.material = material
+        self.temperature = temperature
+        self.voltage = voltage
+        self.num_cables = num_cables
+        self.step = step
+        self.budget = int(round(max_drop / step))
+        # Cost of one meter of run per gauge index. Without prices the
+        # conductor cross section is used, cost then follows the metal used.
+        self.costs = [
+            (gauge_cost or {}).get(gauge, engine.areas_si[i] * 1e6) * num_cables
+            for i, gauge in enumerate(engine.gauges)
+        ]
+        self._signatures = {}
+        self._shapes = []
+        self._memo = {}
+
+    # Number of budget steps a drop takes, rounded up
+    def _steps(self, drop):
+        return int(math.ceil(drop / self.step - 1e-9))
+
+    def _signature(self, segment):
+        children = Counter(self._signature(child) for child in segment.children)
+        segment.current = segment.load + sum(
+            child.current for child in segment.children)
+        shape = (segment.length, segment.current, tuple(sorted(children.items())))
+        signature = self._signatures.get(shape)
+        if signature is None:
+            signature = len(self._shapes)
+            self._signatures[shape] = signature
+            self._shapes.append(self._options(segment.length, segment.current) + (shape[2],))
+        segment.signature = signature
+        return signature
+
+    # Gauges able to carry the current, with their cost and drop in steps
+    def _options(self, length, current):
+        base = self.engine.base_index(current, self.material, self.temperature)
+        if base is None:
+            return ((), current)
+        options = []
+        for i in range(base, len(self.engine.gauges)):
+            drop = self.engine.drop_at(
+                i, current, length, self.material, self.voltage, self.num_cables)
+            options.append((i, self.costs[i] * length, self._steps(drop)))
+        return (tuple(options), current)
+
+    # Cheapest cost of the subtree within budget steps, and the gauge used
+    def _solve(self, signature, budget):
+        key = (signature, budget)
+        if key in self._memo:
+            return self._memo[key]
+        options, _current, children = self._shapes[signature]
+        best = (INFINITY, None)
+        for index, cost, steps in options:
+            if steps > budget or cost >= best[0]:
+                continue
+            total = cost
+            for child, count in children:
+                child_cost = self._solve(child, budget - steps)[0]
+                total += child_cost * count
+                if total >= best[0]:
+                    break
+            if total < best[0]:
+                best = (total, index)
+        self._memo[key] = best
+        return best
+
+    def solve(self, roots):
+        results, total = {}, 0.0
+        for root in roots:
+            signature = self._signature(root)
+            if overloaded := self._find_overloaded(root):
+                return CircuitResult({}, None, f'No cable size carries {overloaded.current:g}A on {overloaded.key}')
+            cost, index = self._solve(signature, self.budget)
+            if index is None:
+                return CircuitResult({}, None, f'No gauges keep the voltage drop under the limit from {root.key}')
+            total += cost
+            self._assign(root, self.budget, 0.0, results)
+        return CircuitResult(results, total, None)
+
+    def _find_overloaded(self, segment):
+        if not self._shapes[segment.signature][0]:
+            return segment
+        for child in segment.children:
+            if overloaded := self._find_overloaded(child):
+                return overloaded
+        return None
+
+    # Walk down the circuit replaying the memoized choices
+    def _assign(self, segment, budget, upstream, results):
+        _cost, index = self._solve(segment.signature, budget)
+        drop = self.engine.drop_at(
+            index, segment.current, segment.length,
+            self.material, self.voltage, self.num_cables)
+        results[segment.key] = SegmentResult(
+            self.engine.gauges[index], segment.current, drop, upstream + drop)
+        steps = self._steps(drop)
+        for child in segment.children:
+            self._assign(child, budget - steps, upstream + drop, results)
@@ -0,0 +1,63 @@
+import os
+import logging
+import subprocess
+import tempfile
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+_logger = logging.getLogger(__name__)
+
+
+# wkhtmltopdf processes running at the same time in this server process,
+# shared by every batch so month-end runs cannot flood the machine
+PDF_WORKERS = 4
+
+# Seconds one report may take to render
+TIMEOUT = 120
+
+_SLOTS = threading.BoundedSemaphore(PDF_WORKERS)
+
+
+def render_pdf(binary, args, body, header=None, footer=None, timeout=TIMEOUT):
+    # Render one HTML document to PDF with its own wkhtmltopdf process.
+    # args are the wkhtmltopdf options (paper format, margins, cookies).
+    with tempfile.TemporaryDirectory(prefix='inspection-report-') as directory:
+        command = [binary] + list(args)
+        for flag, html in (('--header-html', header), ('--footer-html', footer)):
+            if html:
+                path = os.path.join(directory, flag[2:] + '.html')
+                with open(path, 'wb') as f:
+                    f.write(html if isinstance(html, bytes) else html.encode('utf-8'))
+                command += [flag, path]
+        body_path = os.path.join(directory, 'body.html')
+        pdf_path = os.path.join(directory, 'report.pdf')
+        with open(body_path, 'wb') as f:
+            f.write(body if isinstance(body, bytes) else body.encode('utf-8'))
+        command += [body_path, pdf_path]
+        with _SLOTS:
+            process = subprocess.run(
+                command, stdout=subprocess.PIPE, stderr=subprocess.PIPE, timeout=timeout)
+        # 1 means the PDF was written with warnings (missing assets and such)
+        if process.returncode not in (0, 1):
+            raise RuntimeError(process.stderr.decode('utf-8', 'replace')[-1000:]
+                               or f'wkhtmltopdf exited with {process.returncode}')
+        with open(pdf_path, 'rb') as f:
+            return f.read()
+
+
+def render_many(binary, args, jobs, header=None, footer=None,
+                max_workers=PDF_WORKERS, timeout=TIMEOUT):
+    # {key: body html} -> {key: (pdf bytes, error)}, rendered concurrently.
+    # Threads only wait on the processes, the work happens in wkhtmltopdf.
+    def render(body):
+        try:
+            return render_pdf(binary, args, body, header, footer, timeout), None
+        except Exception as e:
+            return None, str(e) or type(e).__name__
+
+    if not jobs:
+        return {}
+    workers = max(1, min(max_workers, len(jobs)))
+    with ThreadPoolExecutor(max_workers=workers, thread_name_prefix='inspection-pdf') as executor:
+        futures = {key: executor.submit(render, body) for key, body in jobs.items()}
+        return {key: future.result() for key, future in futures.items()}
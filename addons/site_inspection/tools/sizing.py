@@ -0,0 +1,267 @@
+import os
+import json
+import math
+import logging
+from bisect import bisect_left
+from collections import namedtuple
+
+_logger = logging.getLogger(__name__)
+
+
+# First we setup an AWG table for the cable sizes
+# C = Copper, A = Aluminum
+# 60 = 60C, 75 = 75C, 90 = 90C
+# The values are the Ampacity of the cable
+# The values are based on the NEC 2017 Table 310.15(B)(16)
+
+AWG_TEMP_AMPACITY = {
+    '10': {'C60': 30, 'C75': 35, 'C90': 40, 'A60': 25, 'A75': 30, 'A90': 35},
+    '8': {'C60': 40, 'C75': 50, 'C90': 55, 'A60': 35, 'A75': 40, 'A90': 45},
+    '6': {'C60': 55, 'C75': 65, 'C90': 75, 'A60': 40, 'A75': 50, 'A90': 55},
+    '4': {'C60': 70, 'C75': 85, 'C90': 95, 'A60': 55, 'A75': 65, 'A90': 75},
+    '3': {'C60': 85, 'C75': 100, 'C90': 115, 'A60': 65, 'A75': 75, 'A90': 85},
+    '2': {'C60': 95, 'C75': 115, 'C90': 130, 'A60': 75, 'A75': 90, 'A90': 100},
+    '1': {'C60': 0, 'C75': 130, 'C90': 145, 'A60': 85, 'A75': 100, 'A90': 115},
+    '1/0': {'C60': 0, 'C75': 150, 'C90': 170, 'A60': 100, 'A75': 120, 'A90': 135},
+    '2/0': {'C60': 0, 'C75': 175, 'C90': 195, 'A60': 0, 'A75': 135, 'A90': 150},
+    '3/0': {'C60': 0, 'C75': 200, 'C90': 225, 'A60': 0, 'A75': 155, 'A90': 175},
+    '4/0': {'C60': 0, 'C75': 230, 'C90': 260, 'A60': 0, 'A75': 180, 'A90': 205},
+}
+# The 60C columns stop at 100A like NEC 110.14(C)(1)(a), larger circuits
+# use 75C terminations.
+
+
+# Resistivity of copper and aluminum
+RESISTIVITY = {'C': 1.68e-8, 'A': 2.82e-8}
+
+
+AWG_DIAMETER_INCHES = {
+    '4/0': 0.46,
+    '3/0': 0.4096,
+    '2/0': 0.3648,
+    '1/0': 0.3249,
+    '1': 0.2893,
+    '2': 0.2576,
+    '3': 0.2294,
+    '4': 0.2043,
+    '6': 0.162,
+    '8': 0.1285,
+    '10': 0.1019,
+}
+
+CONDUIT_SIZES_INCHES = {
+    '1/2': 0.5,
+    '3/4': 0.75,
+    '1': 1.0,
+    '1 1/4': 1.25,
+    '1 1/2': 1.5,
+    '2': 2.0,
+    '2 1/2': 2.5,
+}
+
+# Ampacity tables by code. Columns are named material + temperature (C75,
+# A90, ...) and gauges are listed from smallest to largest. More tables are
+# read from JSON files in data/ampacity, one table per file:
+#   {"code": "...", "name": "...", "ampacity": {"<gauge>": {"C75": 35, ...}},
+#    "diameters": {"<gauge>": <inches>}}
+# diameters is only needed for gauges missing from AWG_DIAMETER_INCHES.
+DEFAULT_TABLE = 'nec_2017_310_15_b_16'
+AMPACITY_TABLES = {
+    DEFAULT_TABLE: {
+        'name': 'NEC 2017 Table 310.15(B)(16)',
+        'ampacity': AWG_TEMP_AMPACITY,
+        'diameters': AWG_DIAMETER_INCHES,
+    },
+}
+TABLES_PATH = os.path.join(os.path.dirname(os.path.dirname(__file__)), 'data', 'ampacity')
+
+# Meters per inch, diameters are in inches and resistivity in ohm meter
+INCH = 0.0254
+
+# Conductor length per meter of run: go and return for single phase,
+# sqrt(3) for three phase runs (three cables, line to line voltage)
+PATH_FACTOR = {3: math.sqrt(3)}
+PATH_FACTOR_DEFAULT = 2.0
+
+# Largest AC loss allowed by NEC 2017, in percent
+MAX_AC_LOSS = 3.0
+
+# Conduit fill allowed by NEC for one, two and three or more wires
+CONDUIT_FILL = {1: 0.53, 2: 0.31}
+CONDUIT_FILL_DEFAULT = 0.4
+
+
+# One charger run to size, and what the engine picked for it.
+# Fields of a result are None when error is set.
+SizingRun = namedtuple('SizingRun', [
+    'amperage', 'distance', 'material', 'temperature', 'voltage', 'num_cables'])
+SizingResult = namedtuple('SizingResult', ['cable_size', 'pipe_size', 'ac_loss', 'error'])
+
+
+class AmpacityIndex:
+    # Smallest gauge carrying a current, per column, by bisect. Only gauges
+    # rated higher than every smaller gauge are kept as thresholds, so the
+    # lists are sorted even when a column has unrated (0) gauges.
+
+    def __init__(self, gauges, ampacity):
+        self.columns = {}
+        for column in {column for amps in ampacity.values() for column in amps}:
+            thresholds, indexes, best = [], [], 0
+            for i, gauge in enumerate(gauges):
+                amps = ampacity[gauge].get(column) or 0
+                if amps > best:
+                    thresholds.append(amps)
+                    indexes.append(i)
+                    best = amps
+            self.columns[column] = (thresholds, indexes)
+
+    def lookup(self, column, amperage):
+        thresholds, indexes = self.columns.get(column, ((), ()))
+        i = bisect_left(thresholds, amperage)
+        return indexes[i] if i < len(indexes) else None
+
+
+class SizingEngine:
+    # Cable and conduit sizing for many runs at once. Everything that only
+    # depends on the tables (gauge order, areas, resistance per length,
+    # ampacity columns, conduit diameters) is computed once here, so sizing
+    # a run is a few arithmetic operations and bisects, no table scans.
+
+    def __init__(self, ampacity=AWG_TEMP_AMPACITY, diameters=AWG_DIAMETER_INCHES,
+                 conduits=CONDUIT_SIZES_INCHES, resistivity=RESISTIVITY,
+                 max_loss=MAX_AC_LOSS):
+        self.max_loss = max_loss
+        # Gauges from smallest to largest, the order of the ampacity table
+        self.gauges = list(ampacity)
+        self.index = {gauge: i for i, gauge in enumerate(self.gauges)}
+        # Areas in square inches for conduit fill, in square meters for resistance
+        self.areas = [math.pi * (diameters[gauge] / 2) ** 2 for gauge in self.gauges]
+        if self.areas != sorted(self.areas):
+            raise ValueError('Cable areas must grow with the ampacity table order')
+        self.areas_si = [area * INCH ** 2 for area in self.areas]
+        self.resistivity = dict(resistivity)
+        # Ohm per meter of conductor
+        self.resistance = {
+            material: [rho / area for area in self.areas_si]
+            for material, rho in resistivity.items()
+        }
+        self.ampacity = AmpacityIndex(self.gauges, ampacity)
+        conduits = sorted(conduits.items(), key=lambda item: item[1])
+        self.conduit_sizes = [size for size, _diameter in conduits]
+        self.conduit_diameters = [diameter for _size, diameter in conduits]
+
+    def area(self, gauge):
+        try:
+            return self.areas[self.index[gauge]]
+        except KeyError:
+            raise ValueError(f'Invalid AWG size: {gauge}')
+
+    # Index of the smallest gauge of the material carrying amperage at the
+    # temperature rating, or None
+    def base_index(self, amperage, material, temperature):
+        return self.ampacity.lookup(f'{material}{temperature}', amperage)
+
+    # Voltage drop of a run in percent of the supply voltage, which is also
+    # the share of power lost (I^2 R over V I). distance is in meters.
+    def drop_at(self, index, amperage, distance, material, voltage, num_cables=1):
+        factor = PATH_FACTOR.get(num_cables, PATH_FACTOR_DEFAULT)
+        resistance = self.resistance[material][index] * distance * factor
+        return 100.0 * amperage * resistance / voltage
+
+    def ac_loss(self, gauge, amperage, distance, material, voltage, num_cables=1):
+        return self.drop_at(self.index[gauge], amperage, distance, material, voltage, num_cables)
+
+    # Smallest conduit fitting num_cables of the gauge, or None
+    def conduit_for(self, gauge, num_cables):
+        fill = CONDUIT_FILL.get(num_cables, CONDUIT_FILL_DEFAULT)
+        required_area = self.area(gauge) * num_cables / fill
+        required_diameter = math.sqrt(required_area / math.pi) * 2
+        i = bisect_left(self.conduit_diameters, required_diameter)
+        return self.conduit_sizes[i] if i < len(self.conduit_sizes) else None
+
+    def size(self, run):
+        amperage, distance, material, temperature, voltage, num_cables = run
+        if material not in self.resistivity:
+            return SizingResult(None, None, None, 'Cable material not defined')
+        if not voltage or voltage <= 0:
+            return SizingResult(None, None, None, 'Supply voltage not defined')
+        base = self.base_index(amperage, material, temperature)
+        if base is None:
+            return SizingResult(None, None, None, 'No cable size defined for amperage, material and temperature')
+        # The loss falls with the area, so the smallest area keeping it under
+        # the limit is solved for directly instead of stepping up the gauges.
+        # The largest gauge is used when even it cannot meet the limit.
+        rho = self.resistivity[material]
+        factor = PATH_FACTOR.get(num_cables, PATH_FACTOR_DEFAULT)
+        needed_area = 100.0 * amperage * rho * distance * factor / (self.max_loss * voltage)
+        i = min(max(base, bisect_left(self.areas_si, needed_area)), len(self.gauges) - 1)
+        gauge = self.gauges[i]
+        pipe_size = self.conduit_for(gauge, num_cables)
+        if pipe_size is None:
+            return SizingResult(gauge, None, None, 'No suitable pipe size found')
+        ac_loss = self.drop_at(i, amperage, distance, material, voltage, num_cables)
+        return SizingResult(gauge, pipe_size, ac_loss, None)
+
+    # Chargers of a site are mostly identical runs (same load, material,
+    # rating, distance), each distinct run is sized once and shared
+    def size_many(self, runs):
+        results = {}
+        for run in runs:
+            if run not in results:
+                results[run] = self.size(run)
+        return [results[run] for run in runs]
+
+
+def load_tables(path=TABLES_PATH):
+    # Add the JSON tables found in path to AMPACITY_TABLES. A table whose
+    # gauges lack a diameter is rejected, the engine and the cable size
+    # selection both need the area of every gauge.
+    if not os.path.isdir(path):
+        return
+    for filename in sorted(os.listdir(path)):
+        if not filename.endswith('.json'):
+            continue
+        try:
+            with open(os.path.join(path, filename)) as f:
+                table = json.load(f)
+            ampacity = table['ampacity']
+            diameters = dict(AWG_DIAMETER_INCHES, **table.get('diameters', {}))
+            if not ampacity or not all(isinstance(amps, dict) for amps in ampacity.values()):
+                raise ValueError('ampacity must map each gauge to its columns')
+            if missing := [gauge for gauge in ampacity if gauge not in diameters]:
+                raise ValueError(f'no diameter for gauges {", ".join(missing)}')
+            # Checks the gauge order against the areas before registering
+            SizingEngine(ampacity, diameters)
+            AMPACITY_TABLES[table['code']] = {
+                'name': table.get('name') or table['code'],
+                'ampacity': ampacity,
+                'diameters': diameters,
+            }
+        except (OSError, ValueError, KeyError, TypeError, AttributeError) as e:
+            _logger.error('Ampacity table %s not loaded: %s', filename, e)
+
+
+# One engine per table, built when the table is first used
+ENGINES = {}
+
+
+def get_engine(code=DEFAULT_TABLE):
+    if code not in AMPACITY_TABLES:
+        code = DEFAULT_TABLE
+    if code not in ENGINES:
+        table = AMPACITY_TABLES[code]
+        ENGINES[code] = SizingEngine(table['ampacity'], table['diameters'])
+    return ENGINES[code]
+
+
+# Every gauge of every table, smallest first, for the cable size selection
+def all_gauges():
+    gauges = {}
+    for table in AMPACITY_TABLES.values():
+        for gauge in table['ampacity']:
+            gauges.setdefault(gauge, math.pi * (table['diameters'][gauge] / 2) ** 2)
+    return sorted(gauges, key=gauges.get)
+
+
+load_tables()
+SIZING = get_engine()
@@ -1,6 +1,6 @@
 {
     'name': 'WooSatellite',
-    'version': '1.0.30',
+    'version': '1.0.42',
     'category': 'Tools',
     'summary': 'Simple WooCommerce integration for Odoo',
     'sequence': 10,
@@ -10,13 +10,14 @@
     'website': 'https://www.arthexis.com',
     'depends': ['base', 'sale_management', 'stock', ],
     'external_dependencies': {
-        'python': ['woocommerce'],
+        'python': ['woocommerce', 'PIL'],
     },
     'data': [
         # XML, CSV, and YML files, etc. that you want to include
         'views/woo_satellite_view.xml',
         'views/woo_satellite_menu.xml',
         'security/ir.model.access.csv',
+        'data/woo_satellite_cron.xml',
     ],
     'demo': [],
     'installable': True,
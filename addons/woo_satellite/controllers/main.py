@@ -0,0 +1,56 @@
+import base64
+import hashlib
+import hmac
+import json
+import logging
+
+from odoo import http
+from odoo.http import request, Response
+
+_logger = logging.getLogger(__name__)
+
+
+class WooWebhookController(http.Controller):
+
+    # WooCommerce order webhooks (order.created / order.updated) point here.
+    # The payload is only verified and staged, orders are built later by
+    # the staging cron so the store gets its answer right away.
+    @http.route('/woo_satellite/webhook/<int:satellite_id>/order', type='http',
+                auth='public', methods=['POST'], csrf=False)
+    def order_webhook(self, satellite_id, **kwargs):
+        body = request.httprequest.get_data()
+        headers = request.httprequest.headers
+        satellite = request.env['woo_satellite.satellite'].sudo().browse(satellite_id).exists()
+        if not satellite or not satellite.woo_webhook_secret:
+            return Response(status=404)
+        signature = headers.get('X-WC-Webhook-Signature')
+        if not signature:
+            # WooCommerce pings a new webhook with an unsigned form body
+            return Response(status=200 if body.startswith(b'webhook_id=') else 401)
+        expected = base64.b64encode(hmac.new(
+            satellite.woo_webhook_secret.encode('utf-8'), body, hashlib.sha256).digest())
+        if not hmac.compare_digest(expected, signature.encode('utf-8')):
+            _logger.warning('Rejected webhook with a bad signature for %s', satellite.woo_url)
+            return Response(status=401)
+        try:
+            woo_order_id = int(json.loads(body)['id'])
+        except (ValueError, KeyError, TypeError):
+            return Response(status=400)
+        request.env['woo_satellite.order.staging'].sudo()._stage(
+            satellite, woo_order_id, body.decode('utf-8'),
+            topic=headers.get('X-WC-Webhook-Topic'),
+        )
+        return Response(status=200)
+
+    # JSON export of sync runs, used by the Export JSON list button
+    @http.route('/woo_satellite/sync_runs/export', type='http', auth='user')
+    def export_sync_runs(self, ids='', **kwargs):
+        run_ids = [int(run_id) for run_id in ids.split(',') if run_id.isdigit()]
+        runs = request.env['woo_satellite.sync.run'].browse(run_ids).exists()
+        return request.make_response(
+            json.dumps(runs._get_export_data(), indent=2),
+            headers=[
+                ('Content-Type', 'application/json'),
+                ('Content-Disposition', 'attachment; filename="woo_sync_runs.json"'),
+            ],
+        )
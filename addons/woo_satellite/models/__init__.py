@@ -1 +1,4 @@
 from . import satellite
+from . import stock
+from . import order
+from . import sync_run
@@ -0,0 +1,239 @@
+import json
+import logging
+from odoo import models, fields, api
+from odoo.tools import email_normalize
+
+_logger = logging.getLogger(__name__)
+
+
+# Staged orders turned into sale orders per cron run
+PROCESS_BATCH = 500
+
+# WooCommerce order statuses that become sale orders
+IMPORT_STATUSES = ('processing', 'completed', 'on-hold')
+
+
+# Webhook payloads are stored as they arrive and processed in batches.
+
+class WooOrderStaging(models.Model):
+    _name = 'woo_satellite.order.staging'
+    _description = 'WooCommerce Staged Order'
+    _order = 'id'
+
+    woo_satellite_id = fields.Many2one(
+        'woo_satellite.satellite', string='Satellite',
+        required=True, ondelete='cascade', index=True)
+    woo_order_id = fields.Integer(string='WooCommerce Order ID', required=True, index=True)
+    topic = fields.Char(string='Topic')
+    payload = fields.Text(string='Payload', required=True)
+    state = fields.Selection([
+        ('new', 'New'),
+        ('done', 'Done'),
+        ('skipped', 'Skipped'),
+        ('error', 'Error'),
+    ], string='State', default='new', required=True, index=True)
+    error = fields.Char(string='Error')
+    sale_order_id = fields.Many2one('sale.order', string='Sales Order', ondelete='set null')
+
+    @api.model
+    def _stage(self, satellite, woo_order_id, payload, topic=None):
+        staged = self.create({
+            'woo_satellite_id': satellite.id,
+            'woo_order_id': woo_order_id,
+            'topic': topic,
+            'payload': payload,
+        })
+        self.env.ref('woo_satellite.ir_cron_woo_satellite_order_staging')._trigger()
+        return staged
+
+    @api.model
+    def _cron_process(self, limit=PROCESS_BATCH):
+        staged = self.search([('state', '=', 'new')], limit=limit)
+        if staged:
+            staged._process()
+        if self.search_count([('state', '=', 'new')]):
+            self.env.ref('woo_satellite.ir_cron_woo_satellite_order_staging')._trigger()
+
+    # Turn staged payloads into sale orders with one create for all of them
+    def _process(self):
+        # Only the latest payload of each order matters
+        latest = {}
+        for record in self:
+            latest[(record.woo_satellite_id.id, record.woo_order_id)] = record
+        superseded = self - self.browse([record.id for record in latest.values()])
+
+        existing = {
+            (order['woo_satellite_id'][0], order['woo_order_id'])
+            for order in self.env['sale.order'].search_read([
+                ('woo_satellite_id', 'in', self.mapped('woo_satellite_id').ids),
+                ('woo_order_id', 'in', list({key[1] for key in latest})),
+            ], ['woo_satellite_id', 'woo_order_id'])
+        }
+        orders = {}
+        skipped, errors = superseded, {}
+        for key, record in latest.items():
+            try:
+                data = json.loads(record.payload)
+            except ValueError:
+                errors[record.id] = 'Invalid JSON'
+                continue
+            if not isinstance(data, dict):
+                errors[record.id] = 'Payload is not an order'
+                continue
+            if key in existing or data.get('status') not in IMPORT_STATUSES:
+                skipped |= record
+                continue
+            orders[record.id] = data
+
+        partners, partner_errors = self._resolve_partners(orders)
+        errors.update(partner_errors)
+        products = self._resolve_products(orders)
+
+        vals_by_record = {}
+        for record_id, data in orders.items():
+            if record_id in errors:
+                continue
+            try:
+                vals_by_record[record_id] = self.browse(record_id)._get_sale_order_vals(
+                    data, partners[record_id], products)
+            except (TypeError, ValueError, KeyError) as e:
+                errors[record_id] = str(e) or type(e).__name__
+
+        sale_orders, create_errors = _create_isolated(self.env['sale.order'], vals_by_record)
+        errors.update(create_errors)
+        for record_id, order in sale_orders.items():
+            self.browse(record_id).write({'state': 'done', 'sale_order_id': order.id})
+        skipped.write({'state': 'skipped'})
+        for record_id, error in errors.items():
+            self.browse(record_id).write({'state': 'error', 'error': error})
+        _logger.info('Staged orders: %s created, %s skipped, %s errors',
+                     len(sale_orders), len(skipped), len(errors))
+        return self.env['sale.order'].browse([order.id for order in sale_orders.values()])
+
+    # Values of the sale order of one staged payload, raises ValueError on
+    # data that cannot be imported
+    def _get_sale_order_vals(self, data, partner, products):
+        lines = []
+        for line in data.get('line_items', []):
+            product_id = products.get((self.woo_satellite_id.id, line.get('product_id')))
+            if not product_id:
+                raise ValueError('Unknown WooCommerce product %s' % line.get('product_id'))
+            try:
+                quantity = float(line.get('quantity') or 0)
+                price = float(line.get('price') or 0.0)
+            except (TypeError, ValueError):
+                raise ValueError('Invalid quantity or price on WooCommerce product %s'
+                                 % line.get('product_id'))
+            lines.append((0, 0, {
+                'product_id': product_id,
+                'product_uom_qty': quantity,
+                'price_unit': price,
+            }))
+        return {
+            'partner_id': partner,
+            'partner_invoice_id': partner,
+            'partner_shipping_id': partner,
+            'woo_satellite_id': self.woo_satellite_id.id,
+            'woo_order_id': self.woo_order_id,
+            'client_order_ref': data.get('number') or str(self.woo_order_id),
+            'order_line': lines,
+        }
+
+    # {staged id: partner id} for the payloads in orders, plus errors.
+    # Customers with an email are matched on the normalized email in one
+    # search and created once per email; guests without an email get a
+    # partner of their own.
+    def _resolve_partners(self, orders):
+        keys = {record_id: _partner_key(data) for record_id, data in orders.items()}
+        billing = {}
+        for record_id, data in orders.items():
+            billing.setdefault(keys[record_id] or record_id, _billing(data))
+        emails = list({key for key in keys.values() if key})
+        Partner = self.env['res.partner']
+        partners = {}
+        if emails:
+            for partner in Partner.search_read(
+                    [('email_normalized', 'in', emails)], ['email_normalized'], order='id'):
+                partners.setdefault(partner['email_normalized'], partner['id'])
+        created, failed = _create_isolated(Partner, {
+            key: {
+                'name': ' '.join(map(str, filter(None, [values.get('first_name'), values.get('last_name')])))
+                        or values.get('company') or (key if isinstance(key, str) else False)
+                        or 'WooCommerce Customer',
+                'email': str(values.get('email') or '').strip() or False,
+                'phone': values.get('phone') or False,
+                'street': values.get('address_1') or False,
+                'street2': values.get('address_2') or False,
+                'city': values.get('city') or False,
+                'zip': values.get('postcode') or False,
+            } for key, values in billing.items() if key not in partners
+        })
+        partners.update((key, partner.id) for key, partner in created.items())
+        result, errors = {}, {}
+        for record_id in orders:
+            key = keys[record_id] or record_id
+            if key in partners:
+                result[record_id] = partners[key]
+            else:
+                errors[record_id] = 'Customer: %s' % failed[key]
+        return result, errors
+
+    # {(satellite_id, woo_id): product.product id} for every line, one
+    # indexed query per satellite
+    def _resolve_products(self, orders):
+        woo_ids = {}
+        for record_id, data in orders.items():
+            satellite_ids = woo_ids.setdefault(self.browse(record_id).woo_satellite_id, set())
+            satellite_ids.update(line.get('product_id') for line in data.get('line_items', []))
+        products = {}
+        WooProduct = self.env['woo_satellite.product']
+        for satellite, satellite_woo_ids in woo_ids.items():
+            for woo_id, row in WooProduct.resolve(satellite, list(satellite_woo_ids)).items():
+                products[(satellite.id, woo_id)] = row['product_id']
+        return products
+
+    def retry(self):
+        self.filtered(lambda r: r.state == 'error').write({'state': 'new', 'error': False})
+        self.env.ref('woo_satellite.ir_cron_woo_satellite_order_staging')._trigger()
+
+
+def _billing(data):
+    billing = data.get('billing')
+    return billing if isinstance(billing, dict) else {}
+
+
+# Normalized billing email, empty for guest orders without one
+def _partner_key(data):
+    return email_normalize(str(_billing(data).get('email') or '')) or ''
+
+
+# Create one record per key with a single create, or one at a time in
+# savepoints when the batch fails, so one bad payload only fails itself.
+# Returns ({key: record}, {key: error}).
+def _create_isolated(model, vals_by_key):
+    if not vals_by_key:
+        return {}, {}
+    keys = list(vals_by_key)
+    try:
+        with model.env.cr.savepoint():
+            records = model.create([vals_by_key[key] for key in keys])
+        return dict(zip(keys, records)), {}
+    except Exception:
+        _logger.info('Batch create of %s failed, creating one at a time', model._name)
+    created, errors = {}, {}
+    for key in keys:
+        try:
+            with model.env.cr.savepoint():
+                created[key] = model.create(vals_by_key[key])
+        except Exception as e:
+            errors[key] = str(e) or type(e).__name__
+    return created, errors
+
+
+class SaleOrder(models.Model):
+    _inherit = 'sale.order'
+
+    woo_satellite_id = fields.Many2one(
+        'woo_satellite.satellite', string='WooCommerce Satellite',
+        readonly=True, copy=False, index=True)
+    woo_order_id = fields.Integer(string='WooCommerce Order ID', readonly=True, copy=False, index=True)
@@ -1,14 +1,30 @@
-import io
-import base64
-import requests
+import json
+import queue
+import hashlib
 import logging
-from PIL import Image
-from odoo import models, fields
-from woocommerce import API
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta
+from odoo import models, fields, api
+
+from ..tools.client import WOO_CLIENTS, RATE_LIMIT, fetch_pages
+from ..tools.images import ImageFetcher, make_thumbnails
+from ..tools.stats import SyncStats
 
 _logger = logging.getLogger(__name__)
 
 
+# Satellites synchronized at the same time
+MAX_WORKERS = 8
+
+# Pages waiting to be imported, bounds memory when HTTP outruns the ORM
+MAX_PENDING_PAGES = 16
+
+# Delta syncs look back this far past the watermark, edits saved in the
+# same second as the last product seen would be missed otherwise.
+WATERMARK_OVERLAP = timedelta(minutes=1)
+
+
 # Woo Satellite holds the configuration for each WooCommerce store.
 # This includes the API keys and the URL of the store.
 
@@ -21,16 +37,28 @@ class WooSatellite(models.Model):
     woo_consumer_key = fields.Char(string='Consumer Key', required=True)
     woo_consumer_secret = fields.Char(string='Consumer Secret', required=True)
     woo_test_ok = fields.Boolean(string='Connect OK?', default=False)
+    woo_rate_limit = fields.Float(
+        string='Requests per Second', default=RATE_LIMIT,
+        help='Requests sent to this store per second, 429 and Retry-After answers slow it down further',
+    )
+    woo_webhook_secret = fields.Char(
+        string='Webhook Secret',
+        help='Secret set on the WooCommerce order webhooks, used to check their signature',
+    )
+    woo_products_modified = fields.Datetime(
+        string='Products Synced Up To', readonly=True,
+        help='Last date_modified_gmt seen in WooCommerce, later syncs only fetch newer products',
+    )
 
     # Function to get the WooCommerce API object for the current record.
+    # The client is kept per satellite so its keep-alive session and rate
+    # limiter are shared by every call.
     def get_wcapi(self):
-        wcapi = API(
-            url=self.woo_url,
-            consumer_key=self.woo_consumer_key,
-            consumer_secret=self.woo_consumer_secret,
-            version="wc/v3"
+        return WOO_CLIENTS.get(
+            (self.env.cr.dbname, self.id),
+            self.woo_url, self.woo_consumer_key, self.woo_consumer_secret,
+            rate=self.woo_rate_limit or RATE_LIMIT,
         )
-        return wcapi
 
     # Add a button to test the connection to the WooCommerce store.
     def test_connection(self):
@@ -45,30 +73,319 @@ class WooSatellite(models.Model):
             vals['woo_test_ok'] = False
         return super(WooSatellite, self).write(vals)
 
-    # Download the products from the WooCommerce store.
-    def download_products(self):
+    # Download the products from the WooCommerce stores.
+    # Only products modified since the last run are fetched, unless full.
+    def download_products(self, full=False):
+        results = self._download_products(full=full)
+        messages = []
         for record in self:
-            wcapi = record.get_wcapi()
-            products = wcapi.get("products").json()
-            for product in products:
-                if product['images']:
-                    image_url = product['images'][0]['src']
-                # Create the product in Odoo if it doesn't exist.
-                if not record.env['woo_satellite.product'].search([('woo_id', '=', product['id'])]):
-                    product_id = record.env['woo_satellite.product'].create({
-                        'woo_id': product['id'],
-                        'woo_satellite_id': record.id,
-                        'product_id': record.env['product.product'].create({
-                            'name': product['name'],
-                            'list_price': product['price'],
-                            'standard_price': product['regular_price'],
-                        }).id,
-                        'woo_image_url': image_url,
+            stats, error = results[record.id]
+            self.env['woo_satellite.sync.run']._record(record, 'products', stats, error)
+            if error:
+                _logger.error('Products from %s failed: %s', record.woo_url, error)
+                messages.append('%s: failed, %s' % (record.woo_url, error))
+            else:
+                _logger.info('Products from %s: %s', record.woo_url, stats.summary())
+                messages.append('%s: %s' % (record.woo_url, stats.summary()))
+        failed = any(error for _stats, error in results.values())
+        return {
+            'type': 'ir.actions.client',
+            'tag': 'display_notification',
+            'params': {
+                'title': 'Products Downloaded' if not failed else 'Product Download Failed',
+                'message': '\n'.join(messages),
+                'type': 'success' if not failed else 'warning',
+                'sticky': failed,
+            }
+        }
+
+    # Download every product again and rewrite them even if unchanged.
+    def resync_products(self):
+        return self.download_products(full=True)
+
+    # Stores are isolated by savepoints in _download_products, one failing
+    # store leaves the import and watermark of the others in place
+    @api.model
+    def _cron_download_products(self):
+        self.search([]).download_products()
+
+    def _get_product_params(self, full=False):
+        if not self.woo_products_modified or full:
+            return {}
+        return {
+            'modified_after': (self.woo_products_modified - WATERMARK_OVERLAP).isoformat(),
+            'dates_are_gmt': 'true',
+        }
+
+    # Pages are fetched for all satellites in parallel by worker threads
+    # (HTTP and JSON only) and imported here, in the ORM thread, as soon as
+    # they arrive. Returns {satellite_id: (stats, error)}.
+    def _download_products(self, full=False, max_workers=MAX_WORKERS):
+        stats = {record.id: SyncStats() for record in self}
+        errors = {}
+        if not self:
+            return {}
+        watermarks = {record.id: record.woo_products_modified for record in self}
+        pages = queue.Queue(maxsize=MAX_PENDING_PAGES)
+        # One event per satellite, a store failing to import stops fetching.
+        # End markers are still queued for stopped stores, until closing.
+        stops = {record.id: threading.Event() for record in self}
+        closing = threading.Event()
+
+        def put(item, stop):
+            while not stop.is_set():
+                try:
+                    pages.put(item, timeout=1)
+                    return
+                except queue.Full:
+                    continue
+
+        def fetch(satellite_id, client, params):
+            stop = stops[satellite_id]
+            try:
+                for items in fetch_pages(client, 'products', stats[satellite_id], params, stop):
+                    put((satellite_id, items, None), stop)
+                put((satellite_id, None, None), closing)
+            except Exception as e:
+                put((satellite_id, None, str(e) or type(e).__name__), closing)
+
+        executor = ThreadPoolExecutor(
+            max_workers=max(1, min(max_workers, len(self))),
+            thread_name_prefix='woo-sync',
+        )
+        try:
+            for record in self:
+                executor.submit(fetch, record.id, record.get_wcapi(), record._get_product_params(full))
+            remaining = len(self)
+            while remaining:
+                satellite_id, products, error = pages.get()
+                if products is None:
+                    remaining -= 1
+                    if error:
+                        errors.setdefault(satellite_id, error)
+                    continue
+                if satellite_id in errors:
+                    continue
+                # Each page in its own savepoint, a store whose data breaks
+                # the import fails alone and the others carry on
+                error = self.browse(satellite_id)._import_page(products, stats[satellite_id], full)
+                if error:
+                    errors[satellite_id] = error
+                    stops[satellite_id].set()
+                    continue
+                for product in products:
+                    modified = _parse_woo_date(product.get('date_modified_gmt'))
+                    watermark = watermarks[satellite_id]
+                    if modified and (not watermark or modified > watermark):
+                        watermarks[satellite_id] = modified
+        finally:
+            closing.set()
+            for stop in stops.values():
+                stop.set()
+            executor.shutdown(wait=True)
+
+        # A failed satellite keeps its watermark so nothing is skipped next time
+        for record in self:
+            if record.id in errors:
+                continue
+            if watermarks[record.id] != record.woo_products_modified:
+                record.woo_products_modified = watermarks[record.id]
+            # Images left out by a failure are picked up by the next sync
+            try:
+                with self.env.cr.savepoint():
+                    record._sync_images(stats[record.id], full=full)
+            except Exception as e:
+                _logger.exception('Image sync failed for %s', record.woo_url)
+                self.env['woo_satellite.product']._clear_resolve_cache()
+                errors[record.id] = str(e) or type(e).__name__
+        return {record.id: (stats[record.id], errors.get(record.id)) for record in self}
+
+    # Import one page inside a savepoint, returns the error if it failed.
+    # The resolve cache is not part of the savepoint and may point at rows
+    # that were just rolled back, so it is dropped on failure.
+    def _import_page(self, products, stats, force=False):
+        try:
+            with self.env.cr.savepoint():
+                self._import_products(products, stats, force=force)
+        except Exception as e:
+            _logger.exception('Product import failed for %s', self.woo_url)
+            self.env['woo_satellite.product']._clear_resolve_cache()
+            return str(e) or type(e).__name__
+        return None
+
+    # Create or update one page of products with batched ORM calls.
+    # Products whose payload hash did not change are skipped unless force.
+    def _import_products(self, products, stats, force=False):
+        WooProduct = self.env['woo_satellite.product']
+        with stats.stage('search'):
+            mapping = WooProduct.resolve(self, [product['id'] for product in products])
+        to_create, to_write = {}, {}
+        for product in products:
+            payload_hash = WooProduct._get_payload_hash(product)
+            known = mapping.get(product['id'])
+            if known and known['woo_hash'] == payload_hash and not force:
+                stats.count('skipped')
+                continue
+            vals = WooProduct._get_product_vals(product)
+            if known:
+                to_write[product['id']] = (vals, product, payload_hash)
+            else:
+                # Last occurrence wins if a product shows up twice
+                to_create[product['id']] = (vals, product, payload_hash)
+
+        if to_create:
+            with stats.stage('create'):
+                odoo_products = self.env['product.product'].create(
+                    [vals for vals, _product, _hash in to_create.values()])
+                WooProduct.create([{
+                    'woo_id': woo_id,
+                    'woo_satellite_id': self.id,
+                    'product_id': odoo_product.id,
+                    'woo_image_url': WooProduct._get_image_url(product),
+                    'woo_hash': payload_hash,
+                } for (woo_id, (_vals, product, payload_hash)), odoo_product
+                    in zip(to_create.items(), odoo_products)])
+            stats.count('created', len(to_create))
+
+        if to_write:
+            with stats.stage('write'):
+                # Identical values share a single write
+                groups = {}
+                for woo_id, (vals, _product, _hash) in to_write.items():
+                    groups.setdefault(tuple(sorted(vals.items())), []).append(
+                        mapping[woo_id]['product_id'])
+                for vals, product_ids in groups.items():
+                    self.env['product.product'].browse(product_ids).write(dict(vals))
+                for woo_id, (_vals, product, payload_hash) in to_write.items():
+                    WooProduct.browse(mapping[woo_id]['id']).write({
+                        'woo_image_url': WooProduct._get_image_url(product),
+                        'woo_hash': payload_hash,
                     })
-                # Update the product in Odoo if it exists.
-                else:
-                    record.env['woo_satellite.product'].search(
-                        [('woo_id', '=', product['id'])]).woo_update_product(product)
+            stats.count('updated', len(to_write))
+
+
+    # Download the product images again, unchanged ones are answered with
+    # a 304 and left alone.
+    def sync_images(self):
+        messages = []
+        for record in self:
+            stats = SyncStats()
+            record._sync_images(stats, full=True)
+            self.env['woo_satellite.sync.run']._record(record, 'images', stats)
+            _logger.info('Images from %s: %s', record.woo_url, stats.summary())
+            messages.append('%s: %s' % (record.woo_url, stats.summary()))
+        return {
+            'type': 'ir.actions.client',
+            'tag': 'display_notification',
+            'params': {
+                'title': 'Images Synchronized',
+                'message': '\n'.join(messages),
+                'type': 'success',
+                'sticky': False,
+            }
+        }
+
+    # Image stage of the product sync. Each distinct URL is downloaded once,
+    # concurrently and with the validators of the last download, each
+    # distinct image is resized once in worker processes, and products
+    # sharing an image get it in a single write. Without full only products
+    # whose image URL changed since the last sync are looked at.
+    def _sync_images(self, stats, full=False):
+        self.ensure_one()
+        WooProduct = self.env['woo_satellite.product']
+        with stats.stage('search'):
+            woo_products = WooProduct.search([('woo_satellite_id', '=', self.id)])
+            if not full:
+                woo_products = woo_products.filtered(
+                    lambda p: p.woo_image_url != p.woo_image_synced_url)
+
+        # Images removed in the store are removed here too
+        removed = woo_products.filtered(lambda p: not p.woo_image_url)
+        if removed:
+            with stats.stage('write'):
+                removed.mapped('product_id').write({'image_1920': False})
+                removed.write({
+                    'woo_image_synced_url': False,
+                    'woo_image_checksum': False,
+                    'woo_image_etag': False,
+                    'woo_image_modified': False,
+                })
+            stats.count('images removed', len(removed))
+
+        by_url = {}
+        for woo_product in woo_products - removed:
+            by_url.setdefault(woo_product.woo_image_url, WooProduct)
+            by_url[woo_product.woo_image_url] |= woo_product
+        if not by_url:
+            return stats
+        # Conditional requests only when every product already has this URL
+        validators = {}
+        for url, url_products in by_url.items():
+            synced = url_products.filtered(lambda p: p.woo_image_synced_url == url)
+            known = {(p.woo_image_etag, p.woo_image_modified) for p in synced}
+            if synced == url_products and len(known) == 1:
+                validators[url] = known.pop()
+            else:
+                validators[url] = (None, None)
+
+        fetcher = ImageFetcher()
+        try:
+            with stats.stage('images http'):
+                responses = fetcher.fetch_many(validators, stats)
+        finally:
+            fetcher.close()
+
+        # Products that need the image itself, by content checksum
+        contents, targets = {}, {}
+        for url, response in responses.items():
+            if response.status == 'failed':
+                _logger.warning('Image %s from %s failed: %s', url, self.woo_url, response.error)
+                continue
+            if response.status == 'modified':
+                stale = by_url[url].filtered(lambda p: p.woo_image_checksum != response.checksum)
+                if stale:
+                    contents[response.checksum] = response.content
+                    targets.setdefault(response.checksum, WooProduct)
+                    targets[response.checksum] |= stale
+        with stats.stage('images resize'):
+            thumbnails = make_thumbnails(contents)
+
+        with stats.stage('write'):
+            for checksum, image_products in targets.items():
+                image, error = thumbnails[checksum]
+                if error:
+                    _logger.warning('Image %s from %s is unreadable: %s',
+                                    image_products[0].woo_image_url, self.woo_url, error)
+                    continue
+                image_products.mapped('product_id').write({'image_1920': image})
+                stats.count('images written', len(image_products))
+            # Remember the validators so the next sync can ask for a 304
+            for url, response in responses.items():
+                if response.status == 'failed':
+                    continue
+                if response.checksum in thumbnails and thumbnails[response.checksum][1]:
+                    continue
+                vals = {
+                    'woo_image_synced_url': url,
+                    'woo_image_etag': response.etag or False,
+                    'woo_image_modified': response.last_modified or False,
+                }
+                if response.checksum:
+                    vals['woo_image_checksum'] = response.checksum
+                by_url[url].write(vals)
+        return stats
+
+
+# Key of the resolve() cache in the cursor's precommit data, and the
+# fields whose changes invalidate it
+RESOLVE_CACHE = 'woo_satellite.product.resolve'
+RESOLVE_FIELDS = {'woo_id', 'woo_satellite_id', 'product_id', 'woo_hash'}
+
+
+def _parse_woo_date(value):
+    if not value:
+        return None
+    return datetime.fromisoformat(value[:19])
 
 
 # Woo Product holds the information of each product in the WooCommerce store.
@@ -81,14 +398,87 @@ class WooProduct(models.Model):
 
     woo_id = fields.Integer(string='WooCommerce ID', required=True)
     woo_satellite_id = fields.Many2one('woo_satellite.satellite', string='Satellite', required=True)
-    product_id = fields.Many2one('product.product', string='Product', required=True, ondelete='cascade')
+    product_id = fields.Many2one('product.product', string='Product', required=True, ondelete='cascade', index=True)
     woo_image_url = fields.Char(string='Image URL')
+    woo_image_synced_url = fields.Char(string='Synced Image URL', readonly=True, copy=False)
+    woo_image_checksum = fields.Char(
+        string='Image Checksum', readonly=True, copy=False,
+        help='SHA-256 of the image last downloaded from the store',
+    )
+    woo_image_etag = fields.Char(string='Image ETag', readonly=True, copy=False)
+    woo_image_modified = fields.Char(string='Image Last-Modified', readonly=True, copy=False)
+    woo_hash = fields.Char(string='Payload Hash', readonly=True, copy=False)
+
+    # Also the index behind every (satellite, woo_id) lookup
+    _sql_constraints = [
+        ('woo_satellite_woo_id_uniq', 'unique(woo_satellite_id, woo_id)',
+         'A WooCommerce product can only be mapped once per satellite.'),
+    ]
+
+    @api.model_create_multi
+    def create(self, vals_list):
+        self._clear_resolve_cache()
+        return super(WooProduct, self).create(vals_list)
+
+    def write(self, vals):
+        if RESOLVE_FIELDS.intersection(vals):
+            self._clear_resolve_cache()
+        return super(WooProduct, self).write(vals)
+
+    def unlink(self):
+        self._clear_resolve_cache()
+        return super(WooProduct, self).unlink()
+
+    # Mappings of the given woo ids in one satellite, with one indexed query
+    # for the ids not seen yet in this transaction. Returns
+    # {woo_id: {'id', 'product_id', 'woo_hash'}}, unknown ids are left out.
+    @api.model
+    def resolve(self, satellite, woo_ids):
+        cache = self.env.cr.precommit.data.setdefault(RESOLVE_CACHE, {})
+        known = cache.setdefault(satellite.id, {})
+        missing = {woo_id for woo_id in woo_ids if woo_id not in known}
+        if missing:
+            self.flush(list(RESOLVE_FIELDS))
+            self.env.cr.execute("""
+                SELECT woo_id, id, product_id, woo_hash
+                  FROM woo_satellite_product
+                 WHERE woo_satellite_id = %s AND woo_id IN %s
+            """, (satellite.id, tuple(missing)))
+            for woo_id, record_id, product_id, woo_hash in self.env.cr.fetchall():
+                known[woo_id] = {'id': record_id, 'product_id': product_id, 'woo_hash': woo_hash}
+                missing.discard(woo_id)
+            # Misses are remembered too, any create drops the cache
+            known.update(dict.fromkeys(missing))
+        return {woo_id: known[woo_id] for woo_id in woo_ids if known.get(woo_id)}
+
+    # The cache lives in the precommit data, so commit and rollback drop it
+    def _clear_resolve_cache(self):
+        self.env.cr.precommit.data.pop(RESOLVE_CACHE, None)
+
+    # Values for product.product from the WooCommerce data.
+    def _get_product_vals(self, product):
+        return {
+            'name': product['name'],
+            'list_price': float(product['price']) if product['price'] else 0.0,
+            'standard_price': float(product['regular_price']) if product['regular_price'] else 0.0,
+        }
+
+    # Hash of the parts of the WooCommerce payload we import, unchanged
+    # products can then be skipped without touching the ORM.
+    def _get_payload_hash(self, product):
+        payload = {
+            'name': product['name'],
+            'price': product['price'],
+            'regular_price': product['regular_price'],
+            'image': self._get_image_url(product),
+        }
+        return hashlib.sha1(json.dumps(payload, sort_keys=True).encode('utf-8')).hexdigest()
+
+    def _get_image_url(self, product):
+        images = product.get('images')
+        return images[0]['src'] if images else False
 
     # Function to update the product in Odoo from the WooCommerce data.
     def woo_update_product(self, product):
         for record in self:
-            record.product_id.write({
-                'name': product['name'],
-                'list_price': float(product['price']) if product['price'] else 0.0,
-                'standard_price': float(product['regular_price']) if product['regular_price'] else 0.0,
-            })
+            record.product_id.write(self._get_product_vals(product))
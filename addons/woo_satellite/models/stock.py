@@ -0,0 +1,300 @@
+import logging
+from datetime import timedelta
+from psycopg2 import errors as pg_errors
+from odoo import models, fields, api
+
+from ..tools.stats import SyncStats
+
+_logger = logging.getLogger(__name__)
+
+
+# Largest number of items accepted by the products/batch endpoint
+BATCH_SIZE = 100
+
+# Attempts for items the store rejected or batches that failed outright
+MAX_ATTEMPTS = 3
+
+# Seconds stock changes to the same product are collapsed into one push
+DEBOUNCE_SECONDS = 60
+
+# Outbox rows handled per cron run
+DRAIN_BATCH = 5000
+
+# Cron runs a row may fail before it is parked as failed
+OUTBOX_ATTEMPTS = 5
+
+
+# Odoo is the source of truth for stock, quantities are pushed to each
+# satellite through the WooCommerce products/batch endpoint.
+
+class WooSatelliteStock(models.Model):
+    _inherit = 'woo_satellite.satellite'
+
+    def push_stock(self):
+        messages = []
+        for record in self:
+            stats, _failed = record._push_stock()
+            self.env['woo_satellite.sync.run']._record(record, 'stock', stats)
+            summary = '%s, %.0f items/s' % (
+                stats.summary(), stats.counters['pushed'] / (stats.wall_time or 1))
+            _logger.info('Stock to %s: %s', record.woo_url, summary)
+            messages.append('%s: %s' % (record.woo_url, summary))
+        return {
+            'type': 'ir.actions.client',
+            'tag': 'display_notification',
+            'params': {
+                'title': 'Stock Pushed',
+                'message': '\n'.join(messages),
+                'type': 'success',
+                'sticky': False,
+            }
+        }
+
+    # Push the quantity of every mapped product whose stock changed since
+    # the last push (or all of them with force). woo_products restricts the
+    # push to those mappings. Returns the SyncStats of the run and the
+    # woo ids the store did not accept.
+    def _push_stock(self, woo_products=None, force=False):
+        self.ensure_one()
+        stats = SyncStats()
+        WooProduct = self.env['woo_satellite.product']
+        with stats.stage('search'):
+            if woo_products is None:
+                woo_products = WooProduct.search([('woo_satellite_id', '=', self.id)])
+            else:
+                woo_products = woo_products.filtered(lambda p: p.woo_satellite_id == self)
+            # qty_available is computed for the whole recordset at once
+            quantities = {
+                row['id']: row['qty_available']
+                for row in woo_products.mapped('product_id').read(['qty_available'])
+            }
+        updates = {}
+        for woo_product in woo_products:
+            quantity = int(quantities.get(woo_product.product_id.id, 0.0))
+            if force or not woo_product.woo_stock_date or woo_product.woo_stock_qty != quantity:
+                updates[woo_product.woo_id] = (woo_product.id, quantity)
+            else:
+                stats.count('skipped')
+        if not updates:
+            return stats, set()
+
+        wcapi = self.get_wcapi()
+        pending = list(updates)
+        pushed = {}
+        for attempt in range(MAX_ATTEMPTS):
+            failed = []
+            for start in range(0, len(pending), BATCH_SIZE):
+                chunk = pending[start:start + BATCH_SIZE]
+                failed += self._push_stock_batch(wcapi, chunk, updates, pushed, stats)
+            if not failed:
+                break
+            stats.count('retried', len(failed))
+            pending = failed
+        else:
+            stats.count('failed', len(pending))
+            _logger.warning('Stock push to %s gave up on WooCommerce ids %s', self.woo_url, pending)
+
+        # Remember what the store has now, one write per quantity
+        with stats.stage('write'):
+            now = fields.Datetime.now()
+            by_quantity = {}
+            for woo_id, quantity in pushed.items():
+                by_quantity.setdefault(quantity, []).append(updates[woo_id][0])
+            for quantity, ids in by_quantity.items():
+                WooProduct.browse(ids).write({'woo_stock_qty': quantity, 'woo_stock_date': now})
+        stats.count('pushed', len(pushed))
+        return stats, set(updates) - set(pushed)
+
+    # Send one products/batch request, returns the woo ids to retry
+    def _push_stock_batch(self, wcapi, woo_ids, updates, pushed, stats):
+        payload = {'update': [
+            {'id': woo_id, 'manage_stock': True, 'stock_quantity': updates[woo_id][1]}
+            for woo_id in woo_ids
+        ]}
+        try:
+            with stats.stage('http'):
+                response = wcapi.post('products/batch', payload)
+                response.raise_for_status()
+            stats.count('batches')
+            with stats.stage('json'):
+                results = response.json().get('update', [])
+        except Exception as e:
+            _logger.warning('Stock batch to %s failed: %s', self.woo_url, e)
+            return list(woo_ids)
+        # Items come back in request order, rejected ones carry an error
+        failed = []
+        for index, woo_id in enumerate(woo_ids):
+            result = results[index] if index < len(results) else {'error': 'missing'}
+            if result.get('error'):
+                failed.append(woo_id)
+            else:
+                pushed[woo_id] = updates[woo_id][1]
+        return failed
+
+
+class WooProductStock(models.Model):
+    _inherit = 'woo_satellite.product'
+
+    woo_stock_qty = fields.Float(
+        string='Pushed Stock', readonly=True, copy=False,
+        help='Quantity last accepted by the WooCommerce store',
+    )
+    woo_stock_date = fields.Datetime(string='Stock Pushed On', readonly=True, copy=False)
+
+
+# Stock changes are queued here instead of being pushed from inside the
+# stock transaction. Each product has at most one pending row, later changes
+# within the debounce window collapse into it, and a cron drains the queue.
+# Every change bumps the row's version, the drain only deletes rows whose
+# version did not move while it was pushing.
+
+class WooStockOutbox(models.Model):
+    _name = 'woo_satellite.stock.outbox'
+    _description = 'WooCommerce Stock Outbox'
+    _order = 'date_due, id'
+
+    woo_product_id = fields.Many2one(
+        'woo_satellite.product', string='WooCommerce Product',
+        required=True, ondelete='cascade', index=True)
+    woo_satellite_id = fields.Many2one(
+        'woo_satellite.satellite', string='Satellite',
+        required=True, ondelete='cascade', index=True)
+    state = fields.Selection([
+        ('pending', 'Pending'),
+        ('failed', 'Failed'),
+    ], string='State', default='pending', required=True)
+    date_due = fields.Datetime(string='Due', required=True, index=True, default=fields.Datetime.now)
+    attempts = fields.Integer(string='Attempts', default=0)
+    error = fields.Char(string='Error')
+    version = fields.Integer(string='Version', default=1, readonly=True)
+
+    def init(self):
+        # Lets enqueue rely on ON CONFLICT to collapse repeated changes
+        self.env.cr.execute("""
+            CREATE UNIQUE INDEX IF NOT EXISTS woo_satellite_stock_outbox_pending_uniq
+            ON woo_satellite_stock_outbox (woo_product_id) WHERE state = 'pending'
+        """)
+
+    def _get_debounce(self):
+        return int(self.env['ir.config_parameter'].sudo().get_param(
+            'woo_satellite.stock_debounce', DEBOUNCE_SECONDS))
+
+    # Queue a push for every satellite mapping of the given product.product
+    # ids. Runs inside the stock transaction, so it is a single INSERT. A
+    # product that already has a pending row gets its version bumped; if
+    # that row is already due (a drain may be pushing it right now) it is
+    # also pushed back by the debounce, so the change goes out next run.
+    @api.model
+    def _enqueue_products(self, product_ids):
+        if not product_ids:
+            return
+        now = fields.Datetime.now()
+        due = now + timedelta(seconds=self._get_debounce())
+        self.env.cr.execute("""
+            INSERT INTO woo_satellite_stock_outbox AS outbox
+                (woo_product_id, woo_satellite_id, state, date_due, attempts, version,
+                 create_uid, create_date, write_uid, write_date)
+            SELECT wp.id, wp.woo_satellite_id, 'pending', %(due)s, 0, 1,
+                   %(uid)s, %(now)s, %(uid)s, %(now)s
+              FROM woo_satellite_product wp
+             WHERE wp.product_id IN %(product_ids)s
+            ON CONFLICT (woo_product_id) WHERE state = 'pending' DO UPDATE
+               SET version = outbox.version + 1,
+                   date_due = CASE WHEN outbox.date_due <= %(now)s
+                                   THEN EXCLUDED.date_due ELSE outbox.date_due END,
+                   write_uid = EXCLUDED.write_uid,
+                   write_date = EXCLUDED.write_date
+            RETURNING outbox.date_due = %(due)s
+        """, {
+            'due': due,
+            'now': now,
+            'uid': self.env.uid,
+            'product_ids': tuple(product_ids),
+        })
+        # Rows already waiting for a later run need no new trigger
+        if any(moved for moved, in self.env.cr.fetchall()):
+            self.env.ref('woo_satellite.ir_cron_woo_satellite_stock_outbox')._trigger(at=due)
+        self.invalidate_cache(['version', 'date_due', 'write_uid', 'write_date'])
+
+    @api.model
+    def _cron_drain(self, limit=DRAIN_BATCH):
+        rows = self.search([
+            ('state', '=', 'pending'),
+            ('date_due', '<=', fields.Datetime.now()),
+        ], limit=limit)
+        # Versions are read before any quantity, a change after this point
+        # bumps the version and keeps its row for the next run
+        versions = {row['id']: row['version'] for row in rows.read(['version'])}
+        for satellite in rows.mapped('woo_satellite_id'):
+            satellite_rows = rows.filtered(lambda r: r.woo_satellite_id == satellite)
+            try:
+                stats, failed = satellite._push_stock(satellite_rows.mapped('woo_product_id'))
+                error = 'Rejected by the store' if failed else False
+            except Exception as e:
+                _logger.exception('Stock outbox for %s failed', satellite.woo_url)
+                stats = SyncStats()
+                failed = set(satellite_rows.mapped('woo_product_id.woo_id'))
+                error = str(e) or type(e).__name__
+            else:
+                _logger.info('Stock outbox for %s: %s', satellite.woo_url, stats.summary())
+            self.env['woo_satellite.sync.run']._record(satellite, 'stock', stats, error)
+            done = satellite_rows.filtered(lambda r: r.woo_product_id.woo_id not in failed)
+            retry = satellite_rows - done
+            done._unlink_unchanged(versions)
+            retry._retry_later(error)
+            self.env.cr.commit()
+        if self.search_count([('state', '=', 'pending'), ('date_due', '<=', fields.Datetime.now())]):
+            self.env.ref('woo_satellite.ir_cron_woo_satellite_stock_outbox')._trigger()
+
+    # Delete the rows still at the version the drain read, rows bumped by a
+    # change during the push stay pending with their new due date
+    def _unlink_unchanged(self, versions):
+        if not self:
+            return
+        try:
+            with self.env.cr.savepoint():
+                self.env.cr.execute("""
+                    DELETE FROM woo_satellite_stock_outbox outbox
+                     USING unnest(%s::int[], %s::int[]) AS seen(id, version)
+                     WHERE outbox.id = seen.id AND outbox.version = seen.version
+                """, (self.ids, [versions[record_id] for record_id in self.ids]))
+        except pg_errors.SerializationFailure:
+            # Changed by a transaction committed during the push, the rows
+            # are pushed again next run
+            _logger.info('Stock outbox rows changed while pushing, kept for the next run')
+        self.invalidate_cache()
+
+    def _retry_later(self, error):
+        now = fields.Datetime.now()
+        for record in self:
+            attempts = record.attempts + 1
+            if attempts >= OUTBOX_ATTEMPTS:
+                record.write({'state': 'failed', 'attempts': attempts, 'error': error})
+            else:
+                record.write({
+                    'attempts': attempts,
+                    'error': error,
+                    'date_due': now + timedelta(seconds=self._get_debounce() * 2 ** attempts),
+                })
+
+
+class StockQuant(models.Model):
+    _inherit = 'stock.quant'
+
+    @api.model_create_multi
+    def create(self, vals_list):
+        quants = super(StockQuant, self).create(vals_list)
+        quants._enqueue_woo_stock()
+        return quants
+
+    def write(self, vals):
+        result = super(StockQuant, self).write(vals)
+        if 'quantity' in vals:
+            self._enqueue_woo_stock()
+        return result
+
+    def _enqueue_woo_stock(self):
+        quants = self.filtered(lambda q: q.location_id.usage == 'internal')
+        if quants:
+            self.env['woo_satellite.stock.outbox'].sudo()._enqueue_products(
+                set(quants.mapped('product_id').ids))
@@ -0,0 +1,133 @@
+import json
+import logging
+from datetime import timedelta
+from odoo import models, fields, api
+
+_logger = logging.getLogger(__name__)
+
+
+# Days sync runs are kept before the autovacuum removes them
+RETENTION_DAYS = 90
+
+
+# One row per satellite synchronization (products, images or stock), with
+# the counters and per-stage timings collected by SyncStats during the run.
+
+class WooSyncRun(models.Model):
+    _name = 'woo_satellite.sync.run'
+    _description = 'WooCommerce Sync Run'
+    _order = 'date_start desc, id desc'
+    _rec_name = 'date_start'
+
+    woo_satellite_id = fields.Many2one(
+        'woo_satellite.satellite', string='Satellite',
+        required=True, ondelete='cascade', index=True)
+    kind = fields.Selection([
+        ('products', 'Products'),
+        ('images', 'Images'),
+        ('stock', 'Stock'),
+    ], string='Kind', required=True, index=True)
+    state = fields.Selection([
+        ('done', 'Done'),
+        ('failed', 'Failed'),
+    ], string='State', required=True, default='done')
+    error = fields.Char(string='Error')
+    date_start = fields.Datetime(string='Started', required=True, index=True)
+    wall_time = fields.Float(string='Wall Time (s)', digits=(16, 3))
+    pages = fields.Integer(string='Pages')
+    bytes_received = fields.Integer(string='Bytes Received')
+    created = fields.Integer(string='Created')
+    updated = fields.Integer(string='Updated')
+    skipped = fields.Integer(string='Skipped')
+    pushed = fields.Integer(string='Pushed')
+    counters = fields.Text(string='Counters', help='Every counter of the run, as JSON')
+    stage_ids = fields.One2many('woo_satellite.sync.run.stage', 'run_id', string='Stages')
+
+    # Store the SyncStats of one satellite run
+    @api.model
+    def _record(self, satellite, kind, stats, error=None):
+        wall_time = stats.wall_time
+        counters = dict(stats.counters)
+        try:
+            with self.env.cr.savepoint():
+                return self.sudo().create({
+                    'woo_satellite_id': satellite.id,
+                    'kind': kind,
+                    'state': 'failed' if error else 'done',
+                    'error': error or False,
+                    'date_start': fields.Datetime.now() - timedelta(seconds=wall_time),
+                    'wall_time': wall_time,
+                    'pages': counters.get('pages', 0),
+                    'bytes_received': counters.get('bytes', 0),
+                    'created': counters.get('created', 0),
+                    'updated': counters.get('updated', 0),
+                    'skipped': counters.get('skipped', 0),
+                    'pushed': counters.get('pushed', 0),
+                    'counters': json.dumps(counters, sort_keys=True),
+                    'stage_ids': [(0, 0, dict(values, name=name))
+                                  for name, values in sorted(stats.stage_report().items())],
+                })
+        except Exception:
+            # Telemetry must never break the sync it describes
+            _logger.exception('Could not record the %s run of %s', kind, satellite.woo_url)
+            return self.browse()
+
+    def _get_export_data(self):
+        return [{
+            'id': run.id,
+            'satellite': run.woo_satellite_id.woo_url,
+            'kind': run.kind,
+            'state': run.state,
+            'error': run.error or None,
+            'date_start': fields.Datetime.to_string(run.date_start),
+            'wall_time': run.wall_time,
+            'pages': run.pages,
+            'bytes_received': run.bytes_received,
+            'created': run.created,
+            'updated': run.updated,
+            'skipped': run.skipped,
+            'pushed': run.pushed,
+            'counters': json.loads(run.counters or '{}'),
+            'stages': {
+                stage.name: {
+                    'calls': stage.calls,
+                    'total': stage.total,
+                    'p50': stage.p50,
+                    'p90': stage.p90,
+                    'p99': stage.p99,
+                    'max': stage.max,
+                }
+                for stage in run.stage_ids
+            },
+        } for run in self]
+
+    # Download the selected runs as a JSON file
+    def export_json(self):
+        return {
+            'type': 'ir.actions.act_url',
+            'url': '/woo_satellite/sync_runs/export?ids=%s' % ','.join(map(str, self.ids)),
+            'target': 'self',
+        }
+
+    @api.autovacuum
+    def _gc_sync_runs(self):
+        self.search([
+            ('date_start', '<', fields.Datetime.now() - timedelta(days=RETENTION_DAYS)),
+        ]).unlink()
+
+
+class WooSyncRunStage(models.Model):
+    _name = 'woo_satellite.sync.run.stage'
+    _description = 'WooCommerce Sync Run Stage'
+    _order = 'total desc'
+
+    run_id = fields.Many2one(
+        'woo_satellite.sync.run', string='Run',
+        required=True, ondelete='cascade', index=True)
+    name = fields.Char(string='Stage', required=True)
+    calls = fields.Integer(string='Calls')
+    total = fields.Float(string='Total (s)', digits=(16, 3))
+    p50 = fields.Float(string='p50 (s)', digits=(16, 4))
+    p90 = fields.Float(string='p90 (s)', digits=(16, 4))
+    p99 = fields.Float(string='p99 (s)', digits=(16, 4))
+    max = fields.Float(string='Max (s)', digits=(16, 4))
@@ -0,0 +1,191 @@
+import logging
+import threading
+import time
+from urllib.parse import urlencode
+
+import requests
+from requests.adapters import HTTPAdapter
+from woocommerce.oauth import OAuth
+
+_logger = logging.getLogger(__name__)
+
+
+# Largest page size accepted by the WooCommerce REST API
+PAGE_SIZE = 100
+
+# Seconds to wait for a store to answer
+TIMEOUT = 30
+
+# Default requests per second allowed against one store
+RATE_LIMIT = 5.0
+
+# Attempts for a request answered with 429 or 503
+MAX_RETRIES = 5
+
+# Backoff used when the store does not send Retry-After
+RETRY_DELAY = 2.0
+RETRY_DELAY_MAX = 60.0
+
+RETRY_STATUS = (429, 503)
+
+
+class TokenBucket:
+    # Thread safe token bucket: rate tokens per second, up to capacity.
+    # pause() blocks every caller until a server-imposed delay has passed.
+
+    def __init__(self, rate=RATE_LIMIT, capacity=None):
+        self.rate = float(rate)
+        self.capacity = float(capacity or max(1.0, rate * 2))
+        self._tokens = self.capacity
+        self._updated = time.monotonic()
+        self._paused_until = 0.0
+        self._lock = threading.Lock()
+
+    def acquire(self):
+        while True:
+            with self._lock:
+                now = time.monotonic()
+                if now < self._paused_until:
+                    wait = self._paused_until - now
+                else:
+                    self._tokens = min(
+                        self.capacity, self._tokens + (now - self._updated) * self.rate)
+                    self._updated = now
+                    if self._tokens >= 1:
+                        self._tokens -= 1
+                        return
+                    wait = (1 - self._tokens) / self.rate
+            time.sleep(wait)
+
+    def pause(self, seconds):
+        with self._lock:
+            self._paused_until = max(self._paused_until, time.monotonic() + seconds)
+            self._tokens = 0
+
+
+def _retry_after(response, attempt):
+    value = response.headers.get('Retry-After')
+    if value:
+        try:
+            return min(float(value), RETRY_DELAY_MAX)
+        except ValueError:
+            pass
+    return min(RETRY_DELAY * 2 ** attempt, RETRY_DELAY_MAX)
+
+
+class WooClient:
+    # Drop-in for woocommerce.API (get/post/put/delete with the same
+    # arguments) that keeps one keep-alive session per store and goes
+    # through the store's rate limiter, backing off on 429/Retry-After.
+
+    def __init__(self, url, consumer_key, consumer_secret, version='wc/v3',
+                 rate=RATE_LIMIT, timeout=TIMEOUT):
+        self.url = url.rstrip('/')
+        self.consumer_key = consumer_key
+        self.consumer_secret = consumer_secret
+        self.version = version
+        self.timeout = timeout
+        self.is_ssl = self.url.startswith('https')
+        self.bucket = TokenBucket(rate)
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=8)
+        self.session.mount('http://', adapter)
+        self.session.mount('https://', adapter)
+        self.session.headers.update({
+            'user-agent': 'WooSatellite Odoo',
+            'accept': 'application/json',
+        })
+        if self.is_ssl:
+            self.session.auth = (consumer_key, consumer_secret)
+
+    def _get_url(self, endpoint):
+        return '%s/wp-json/%s/%s' % (self.url, self.version, endpoint)
+
+    def request(self, method, endpoint, data=None, params=None, **kwargs):
+        url = self._get_url(endpoint)
+        params = dict(params or {})
+        if not self.is_ssl:
+            # Plain HTTP stores need OAuth 1.0a signed URLs
+            if params:
+                url = '%s?%s' % (url, urlencode(params))
+            url = OAuth(
+                url=url, consumer_key=self.consumer_key,
+                consumer_secret=self.consumer_secret,
+                version=self.version, method=method,
+            ).get_oauth_url()
+            params = {}
+        kwargs.setdefault('timeout', self.timeout)
+        for attempt in range(MAX_RETRIES):
+            self.bucket.acquire()
+            response = self.session.request(
+                method, url, params=params, json=data, **kwargs)
+            if response.status_code not in RETRY_STATUS or attempt == MAX_RETRIES - 1:
+                return response
+            delay = _retry_after(response, attempt)
+            _logger.info('%s answered %s, backing off %.1fs', self.url, response.status_code, delay)
+            self.bucket.pause(delay)
+        return response
+
+    def get(self, endpoint, **kwargs):
+        return self.request('GET', endpoint, **kwargs)
+
+    def post(self, endpoint, data, **kwargs):
+        return self.request('POST', endpoint, data=data, **kwargs)
+
+    def put(self, endpoint, data, **kwargs):
+        return self.request('PUT', endpoint, data=data, **kwargs)
+
+    def delete(self, endpoint, **kwargs):
+        return self.request('DELETE', endpoint, **kwargs)
+
+    def close(self):
+        self.session.close()
+
+
+class WooClientCache:
+    # One client per satellite, rebuilt when its settings change
+
+    def __init__(self):
+        self._clients = {}
+        self._lock = threading.Lock()
+
+    def get(self, key, url, consumer_key, consumer_secret, rate=RATE_LIMIT):
+        settings = (url, consumer_key, consumer_secret, rate)
+        with self._lock:
+            cached = self._clients.get(key)
+            if cached and cached[0] == settings:
+                return cached[1]
+            client = WooClient(url, consumer_key, consumer_secret, rate=rate)
+            self._clients[key] = (settings, client)
+        if cached:
+            cached[1].close()
+        return client
+
+    def discard(self, key):
+        with self._lock:
+            cached = self._clients.pop(key, None)
+        if cached:
+            cached[1].close()
+
+
+WOO_CLIENTS = WooClientCache()
+
+
+def fetch_pages(client, endpoint, stats, params=None, stop=None):
+    # Walk every page of a collection, yielding one list of items per page
+    page = 1
+    while not (stop and stop.is_set()):
+        with stats.stage('http'):
+            response = client.get(endpoint, params=dict(params or {}, per_page=PAGE_SIZE, page=page))
+            response.raise_for_status()
+        stats.count('pages')
+        stats.count('bytes', len(response.content))
+        with stats.stage('json'):
+            items = response.json()
+        if not items:
+            break
+        yield items
+        total_pages = int(response.headers.get('X-WP-TotalPages') or 0)
+        if len(items) < PAGE_SIZE or (total_pages and page >= total_pages):
+            break
+        page += 1
@@ -0,0 +1,192 @@
+import io
+import base64
+import hashlib
+import logging
+import threading
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+
+import requests
+from requests.adapters import HTTPAdapter
+from PIL import Image
+
+_logger = logging.getLogger(__name__)
+
+
+# Images fetched at the same time
+DOWNLOAD_WORKERS = 8
+
+# Processes resizing images, and the least images worth starting them for
+RESIZE_WORKERS = 4
+RESIZE_MIN_BATCH = 4
+
+# Largest side of the stored image, what Odoo keeps in image_1920
+MAX_SIZE = 1920
+
+# Seconds to wait for an image
+TIMEOUT = 30
+
+# Resized images kept in memory, by size of their encoded data
+CACHE_BYTES = 64 * 1024 * 1024
+
+
+# Outcome of one download: status is 'modified', 'unchanged' or 'failed'.
+# content is only set for modified images, error only for failed ones.
+class ImageResponse:
+    __slots__ = ('status', 'content', 'checksum', 'etag', 'last_modified', 'error')
+
+    def __init__(self, status, content=None, etag=None, last_modified=None, error=None):
+        self.status = status
+        self.content = content
+        self.checksum = hashlib.sha256(content).hexdigest() if content else None
+        self.etag = etag
+        self.last_modified = last_modified
+        self.error = error
+
+
+class ImageFetcher:
+    # Downloads images over one pooled keep-alive session, sending the
+    # validators of the previous download so unchanged images cost a 304.
+
+    def __init__(self, max_workers=DOWNLOAD_WORKERS, timeout=TIMEOUT):
+        self.max_workers = max_workers
+        self.timeout = timeout
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=4, pool_maxsize=max_workers)
+        self.session.mount('http://', adapter)
+        self.session.mount('https://', adapter)
+        self.session.headers.update({'user-agent': 'WooSatellite Odoo'})
+
+    def fetch(self, url, etag=None, last_modified=None):
+        headers = {}
+        if etag:
+            headers['If-None-Match'] = etag
+        if last_modified:
+            headers['If-Modified-Since'] = last_modified
+        try:
+            response = self.session.get(url, headers=headers, timeout=self.timeout)
+            if response.status_code == 304:
+                return ImageResponse('unchanged', etag=etag, last_modified=last_modified)
+            response.raise_for_status()
+        except Exception as e:
+            return ImageResponse('failed', error=str(e) or type(e).__name__)
+        return ImageResponse(
+            'modified', response.content,
+            etag=response.headers.get('ETag'),
+            last_modified=response.headers.get('Last-Modified'),
+        )
+
+    # {url: (etag, last_modified)} -> {url: ImageResponse}
+    def fetch_many(self, validators, stats=None):
+        if not validators:
+            return {}
+        workers = max(1, min(self.max_workers, len(validators)))
+        with ThreadPoolExecutor(max_workers=workers, thread_name_prefix='woo-image') as executor:
+            futures = {
+                url: executor.submit(self.fetch, url, *validators[url])
+                for url in validators
+            }
+            results = {url: future.result() for url, future in futures.items()}
+        if stats is not None:
+            for result in results.values():
+                stats.count('images %s' % result.status)
+                if result.content:
+                    stats.count('image bytes', len(result.content))
+        return results
+
+    def close(self):
+        self.session.close()
+
+
+def make_thumbnail(content, max_size=MAX_SIZE):
+    # Downscale to fit max_size, keeping the original bytes when they
+    # already fit. Returns the image base64 encoded, ready for image_1920.
+    image = Image.open(io.BytesIO(content))
+    if max(image.size) <= max_size:
+        image.verify()
+        return base64.b64encode(content)
+    image.thumbnail((max_size, max_size), Image.LANCZOS)
+    output = io.BytesIO()
+    if image.mode in ('RGBA', 'LA', 'P'):
+        image.save(output, format='PNG', optimize=True)
+    else:
+        image.convert('RGB').save(output, format='JPEG', quality=90, optimize=True)
+    return base64.b64encode(output.getvalue())
+
+
+def _make_thumbnail_safe(content, max_size):
+    try:
+        return make_thumbnail(content, max_size), None
+    except Exception as e:
+        return None, str(e) or type(e).__name__
+
+
+class ThumbnailCache:
+    # Resized images by checksum of their source, so an image shared by
+    # several products or satellites is only resized once per process.
+
+    def __init__(self, max_bytes=CACHE_BYTES):
+        self.max_bytes = max_bytes
+        self._items = OrderedDict()
+        self._size = 0
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            value = self._items.get(key)
+            if value is not None:
+                self._items.move_to_end(key)
+            return value
+
+    def put(self, key, value):
+        if len(value) > self.max_bytes:
+            return
+        with self._lock:
+            previous = self._items.pop(key, None)
+            if previous is not None:
+                self._size -= len(previous)
+            self._items[key] = value
+            self._size += len(value)
+            while self._size > self.max_bytes:
+                _key, evicted = self._items.popitem(last=False)
+                self._size -= len(evicted)
+
+
+THUMBNAILS = ThumbnailCache()
+
+
+def make_thumbnails(contents, max_size=MAX_SIZE, max_workers=RESIZE_WORKERS):
+    # {checksum: content} -> {checksum: (base64 image, error)}. Images not
+    # in the cache are resized in worker processes, Pillow holds the GIL
+    # for most of the work so threads would not help.
+    results = {}
+    pending = {}
+    for checksum, content in contents.items():
+        cached = THUMBNAILS.get((checksum, max_size))
+        if cached is not None:
+            results[checksum] = (cached, None)
+        else:
+            pending[checksum] = content
+    if not pending:
+        return results
+
+    resized = None
+    if len(pending) >= RESIZE_MIN_BATCH and max_workers > 1:
+        try:
+            with ProcessPoolExecutor(max_workers=min(max_workers, len(pending))) as executor:
+                resized = dict(zip(pending, executor.map(
+                    _make_thumbnail_safe, pending.values(), [max_size] * len(pending))))
+        except (BrokenProcessPool, OSError) as e:
+            _logger.warning('Image process pool unavailable, resizing inline: %s', e)
+    if resized is None:
+        resized = {
+            checksum: _make_thumbnail_safe(content, max_size)
+            for checksum, content in pending.items()
+        }
+
+    for checksum, (image, error) in resized.items():
+        if image is not None:
+            THUMBNAILS.put((checksum, max_size), image)
+        results[checksum] = (image, error)
+    return results
@@ -0,0 +1,59 @@
+import math
+import time
+from collections import defaultdict
+from contextlib import contextmanager
+
+
+class SyncStats:
+    # Counters and per-stage wall time for one synchronization run
+
+    def __init__(self):
+        self.counters = defaultdict(int)
+        self.timings = defaultdict(list)
+        self.started = time.perf_counter()
+
+    @contextmanager
+    def stage(self, name):
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.timings[name].append(time.perf_counter() - started)
+
+    def count(self, name, amount=1):
+        self.counters[name] += amount
+
+    @property
+    def wall_time(self):
+        return time.perf_counter() - self.started
+
+    def stage_time(self, name):
+        return sum(self.timings.get(name, ()))
+
+    def summary(self):
+        counters = ', '.join('%s %s' % (value, name) for name, value in self.counters.items())
+        stages = ', '.join(
+            '%s %.2fs' % (name, sum(values)) for name, values in self.timings.items())
+        return '%s in %.2fs (%s)' % (counters or 'nothing', self.wall_time, stages)
+
+    def percentile(self, name, q):
+        # Nearest-rank percentile of one stage's timings, q in 0..100
+        values = sorted(self.timings.get(name, ()))
+        if not values:
+            return 0.0
+        rank = max(1, int(math.ceil(q / 100.0 * len(values))))
+        return values[rank - 1]
+
+    def stage_report(self):
+        # {stage: {calls, total, p50, p90, p99, max}} for every stage
+        return {
+            name: {
+                'calls': len(values),
+                'total': sum(values),
+                'p50': self.percentile(name, 50),
+                'p90': self.percentile(name, 90),
+                'p99': self.percentile(name, 99),
+                'max': max(values),
+            }
+            for name, values in self.timings.items() if values
+        }